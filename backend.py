@@ -1,101 +1,440 @@
 #!/usr/bin/env python3
 
-from zabbix_utils import ZabbixAPI, Sender
-from copy import deepcopy
+from zabbix_utils import Sender, ItemValue, AsyncSender
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from collections import deque
+from helpers import AsyncMixin, failedChunks
 import time
+import json
 import board
+import world
+import asyncio
 import threading
+import transport
 import config
 
-api = ZabbixAPI(url=config.zabbixAPIPath)
+# One keep-alive connection pool shared by all backend threads
+api = transport.ZabbixTransport()
 api.login(token=config.zabbixAdminToken)
 
 sender = Sender(server=config.zabbixServerIP, port=config.zabbixServerPort)
 
 wordFullLength = len(config.wordFull)
+wordFullMask = (1 << wordFullLength) - 1
+
+# Chunked worlds are too big for one map item, players only get views
+streamViews = config.mapViewport or config.worldChunked
+
+
+# Player progress is a bitmask over config.wordFull positions
+def scoreToStr(mask):
+  return ' '.join(letter if mask >> index & 1 else '_' for index, letter in enumerate(config.wordFull))
+
+
+class PositionRequestHandler(BaseHTTPRequestHandler):
+  def do_POST(self):
+    if self.headers.get('Authorization') != f'Bearer {config.backendToken}':
+      self.send_response(401)
+      return
+
+    self.send_response(200)
+    self.end_headers()
+
+    # Connector sends one NDJSON record per position value, oldest first
+    content_len = int(self.headers.get('Content-Length'))
+    post_body = self.rfile.read(content_len)
+    records = []
+    for line in post_body.decode().splitlines():
+      record = json.loads(line)
+      records.append((record['host']['host'], record['value'], record.get('groups', [])))
+    self.server.backend.receiveRecords(records)
+
+  # Disable log message prints to console
+  def log_message(self, format, *args):
+    return
+
+
+# One connector receiver for all games of an async backend. A game scoped
+# to a player group only gets records of hosts in that group, records
+# without groups go to the games that already know the host
+class PositionRouter:
+  def __init__(self, games):
+    self.games = games
+
+  def receiveRecords(self, records):
+    locations = {backend: [] for playerGroup, backend in self.games}
+    for host, value, groups in records:
+      for playerGroup, backend in self.games:
+        if playerGroup is None or playerGroup in groups or (not groups and host in backend.locations):
+          locations[backend].append((host, value))
+
+    for backend, gameLocations in locations.items():
+      if gameLocations:
+        backend.setLocations(gameLocations)
 
 
 class Backend:
-  def __init__(self, startingBoard):
+  def __init__(self, startingBoard, gameHostName=config.gameMasterHostName, groupids=None):
     self.startingBoard = startingBoard
-    self.board = None
-    self.locations = None
+    self.gameHostName = gameHostName
+    self.groupids = groupids
+    if config.worldChunked:
+      # Only recently used chunks of the world are kept in memory
+      chunks = world.ChunkCache()
+      self.size = config.worldSize
+      self.overlay = world.WorldOverlay(chunks)
+      self.letterSlots = world.LetterIndex(chunks)
+    else:
+      self.size = config.boardSize
+      self.overlay = board.BoardOverlay(startingBoard)
+      self.letterSlots = board.letterSlots(startingBoard)
+    self.overlayLock = threading.Lock()
+    self.mapSeq = 0
+    self.locations = {}
+    self.locationsVersion = 0
+    self.locationsChanged = threading.Condition()
     self.scores = {}
+    self.steps = {}
+    self.itemClocks = {}
+    self.badLocations = {}
+    self.sentScores = {}
+    self.pendingScores = {}
+    self.scoreResults = deque(maxlen=100)
+    self.finished = set()
+    self.sentViews = {}
+    self.viewsVersion = None
+    self.viewsBatchVersion = None
+
+  def setLocations(self, locations):
+    # Store changed player locations, oldest first, and notify waiting
+    # threads. Every change is also kept as a step for scoring. Players
+    # can write anything into their Position item, values that are not
+    # coordinates are logged once per host and skipped
+    changed = False
+    with self.locationsChanged:
+      for hostname, coordinates in locations:
+        if coordinates == '' or self.locations.get(hostname) == coordinates:
+          continue
+        if not self.validCoordinates(coordinates):
+          if self.badLocations.get(hostname) != coordinates:
+            self.badLocations[hostname] = coordinates
+            print(f'[ Bad position ]: {hostname} {coordinates!r}')
+          continue
+        self.locations[hostname] = coordinates
+        self.steps.setdefault(hostname, []).append(coordinates)
+        changed = True
+      if changed:
+        self.locationsVersion += 1
+        self.locationsChanged.notify_all()
+    return changed
+
+  def waitForLocations(self, version):
+    # Block until locations are newer than the given version
+    with self.locationsChanged:
+      self.locationsChanged.wait_for(lambda: self.locationsVersion != version)
+      return self.locationsVersion, dict(self.locations)
+
+  def takeSteps(self):
+    # Positions every player went through since the last call, in order
+    with self.locationsChanged:
+      steps, self.steps = self.steps, {}
+    return steps
+
+  def locationsQuery(self):
+    query = {
+      'search': {'name': 'Position'},
+      'output': ['itemid', 'lastvalue', 'lastclock', 'lastns'],
+      'selectHosts': ['host']
+    }
+    if self.groupids is not None:
+      query['groupids'] = self.groupids
+    return query
+
+  def parseLocationItems(self, items):
+    return [(item['hosts'][0]['host'], item['lastvalue']) for item in items]
+
+  def fetchPlayerLocations(self):
+    return self.parseLocationItems(api.item.get(**self.locationsQuery()))
+
+  def itemClock(self, item):
+    return int(item['lastclock']), int(item['lastns'])
+
+  def historyItems(self, items):
+    # Items that changed since the last poll and had a value before, only
+    # their history can hold positions the poll did not see
+    return [
+      item for item in items
+      if self.itemClocks.get(item['itemid'], (0, 0))[0] and self.itemClocks[item['itemid']] != self.itemClock(item)
+    ]
+
+  def historyQuery(self, items):
+    return {
+      'history': 1,
+      'itemids': [item['itemid'] for item in items],
+      'time_from': min(self.itemClocks[item['itemid']][0] for item in items),
+      'sortfield': 'clock',
+      'sortorder': 'ASC',
+      'output': ['itemid', 'clock', 'ns', 'value']
+    }
+
+  def locationRecords(self, items, history):
+    # Every value stored since the last poll, oldest first, so a letter
+    # stepped on and off between two polls is still collected. The last
+    # value closes the list in case its history row is not written yet
+    hosts = {item['itemid']: item['hosts'][0]['host'] for item in items}
+    records = []
+    for row in sorted(history, key=lambda row: (int(row['clock']), int(row['ns']))):
+      if (int(row['clock']), int(row['ns'])) > self.itemClocks[row['itemid']]:
+        records.append((hosts[row['itemid']], row['value']))
+    for item in items:
+      records.append((hosts[item['itemid']], item['lastvalue']))
+      self.itemClocks[item['itemid']] = self.itemClock(item)
+    return records
+
+  def fetchLocationRecords(self):
+    items = api.item.get(**self.locationsQuery())
+    changed = self.historyItems(items)
+    history = api.history.get(**self.historyQuery(changed)) if changed else []
+    return self.locationRecords(items, history)
+
+  def receiveRecords(self, records):
+    self.setLocations([(host, value) for host, value, groups in records])
 
   def getPlayerLocations(self):
+    if config.positionIngestMode == 'connector':
+      self.receivePlayerLocations()
+    else:
+      self.pollPlayerLocations()
+
+  def pollPlayerLocations(self):
+    # Poll often while players move, back off while nothing changes
+    interval = config.positionPollMin
     while True:
-      # get player locations
-      self.locations = api.item.get(
-        search={'name': 'Position'},
-        output=['hostid', 'lastvalue'],
-        selectHosts='extend'
-      )
+      try:
+        if self.setLocations(self.fetchLocationRecords()):
+          interval = config.positionPollMin
+        else:
+          interval = min(interval * 2, config.positionPollMax)
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
+        interval = config.positionPollMax
+      time.sleep(interval)
 
-  def parsePlayerLocations(self):
+  def receivePlayerLocations(self):
+    # Connector only pushes new values, so load the current state first
+    try:
+      self.setLocations(self.fetchPlayerLocations())
+    except Exception as e:
+      print(f'[ Exception ]: {e}')
+
+    server = HTTPServer((config.webServerIP, config.backendServerPort), PositionRequestHandler)
+    server.backend = self
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Resynchronize in case the connector dropped a delivery
     while True:
-      tempBoard = deepcopy(self.startingBoard)
+      time.sleep(config.positionPollMax)
+      try:
+        self.setLocations(self.fetchPlayerLocations())
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
+
+  def validCoordinates(self, coordinates):
+    coordinates = str(coordinates).split(' ')
+    if len(coordinates) != 2:
+      return False
+    try:
+      int(coordinates[0])
+      int(coordinates[1])
+    except ValueError:
+      return False
+    return True
 
-      for location in self.locations:
-        coordinates = location['lastvalue']
-        if coordinates != '':
-          coordinates = coordinates.split(' ')
-          x = int(coordinates[0])
-          y = int(coordinates[1])
+  def parseCoordinates(self, coordinates):
+    coordinates = str(coordinates).split(' ')
+    x = int(coordinates[0])
+    y = int(coordinates[1])
 
-          # Check if next move is not out of map
-          if x < 0:
-            x = 0
-          elif x > config.boardSize - 1:
-            x =  config.boardSize - 1
+    # Check if next move is not out of map
+    if x < 0:
+      x = 0
+    elif x > self.size - 1:
+      x =  self.size - 1
 
-          if y < 0:
-            y = 0
-          elif y >  config.boardSize - 1:
-            y =  config.boardSize - 1
+    if y < 0:
+      y = 0
+    elif y >  self.size - 1:
+      y =  self.size - 1
 
-          tempBoard[y][x] = config.symbolPlayer
+    return x, y
 
-      self.board = tempBoard
-      time.sleep(0.1)
+  def applyLocations(self, locations):
+    for hostname, coordinates in locations.items():
+      x, y = self.parseCoordinates(coordinates)
+      with self.overlayLock:
+        self.overlay.move(hostname, x, y)
+
+  def parsePlayerLocations(self):
+    version = 0
+    while True:
+      version, locations = self.waitForLocations(version)
+      try:
+        self.applyLocations(locations)
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
 
-  def resetScores(self):
+  def resetScores(self, locations):
     # Initialize scores
-    for location in self.locations:
-      hostname = location['hosts'][0]['host']
-      coordinates = location['lastvalue']
-      if coordinates != '':
-        self.scores[hostname] = []
-        for _ in range(wordFullLength):
-          self.scores[hostname].append('_')
+    for hostname in locations:
+      self.scores[hostname] = 0
 
   def parseScores(self):
-    self.resetScores()
+    version = 0
     while True:
-      for location in self.locations:
-        hostname = location['hosts'][0]['host']
-        coordinates = location['lastvalue']
-        if coordinates != '':
-          coordinates = coordinates.split(' ')
-          currentSymbol = self.startingBoard[int(coordinates[1])][int(coordinates[0])]
-          if currentSymbol in config.wordFull:
-            index = config.wordFull.index(currentSymbol)
-            if index == 2:
-              self.scores[hostname][index] = config.wordFull[index]
-              self.scores[hostname][index + 1] = config.wordFull[index]
-            else:
-              self.scores[hostname][index] = config.wordFull[index]
-        time.sleep(0.5)
+      version, locations = self.waitForLocations(version)
+      try:
+        self.resetScores([hostname for hostname in locations if hostname not in self.scores])
+        self.scorePlayers(self.takeSteps())
+        self.announceFinishers()
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
+
+  def scorePlayers(self, steps):
+    # Every position a player went through can collect a letter, not only
+    # the one it stands on now
+    for hostname, path in steps.items():
+      if hostname in self.scores:
+        for coordinates in path:
+          self.scorePlayer(hostname, coordinates)
+
+  def scorePlayer(self, hostname, coordinates):
+    x, y = self.parseCoordinates(coordinates)
+    self.scores[hostname] |= self.letterSlots.get(y * self.size + x, 0)
+
+  def finishedPlayers(self):
+    return [hostname for hostname, mask in self.scores.items() if mask == wordFullMask]
+
+  def announceFinishers(self):
+    # Every player is announced once, when the mask first covers the word
+    for hostname in self.finishedPlayers():
+      if hostname not in self.finished:
+        self.finished.add(hostname)
+        print(f'{hostname} finished {config.wordFull} on {self.gameHostName}')
+
+  def collectScores(self):
+    # Queue scores that changed since the last successful send
+    for host, score in list(self.scores.items()):
+      if self.sentScores.get(host) != score:
+        self.pendingScores[host] = score
+
+    return list(self.pendingScores.items())
+
+  def scoreItems(self, batch):
+    # Only players whose mask changed get their display string rendered
+    return [ItemValue(host, 'player.score', scoreToStr(score)) for host, score in batch]
+
+  def acknowledgeScores(self, batch, response, chunkSize):
+    self.scoreResults.append(response)
+
+    # Keep values of failed chunks for the next batch
+    failed = failedChunks(response)
+    for idx, (host, score) in enumerate(batch):
+      if idx // chunkSize + 1 not in failed:
+        self.sentScores[host] = score
+        if self.pendingScores.get(host) == score:
+          del self.pendingScores[host]
+
+  def publishScores(self):
+    batch = self.collectScores()
+    if batch:
+      self.acknowledgeScores(batch, sender.send(self.scoreItems(batch)), sender.chunk_size)
 
   def updateScores(self):
     while True:
-      for host in self.scores:
-        sender.send_value(host, 'player.score', str(' '.join(self.scores[host])))
+      try:
+        self.publishScores()
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
       time.sleep(0.25)
 
+  def nextMapFrame(self, tick):
+    # Full board every mapKeyframeInterval ticks, only moves in between
+    with self.overlayLock:
+      if tick % config.mapKeyframeInterval == 0:
+        self.overlay.changes()
+        self.mapSeq += 1
+        return board.keyframe(self.mapSeq, self.overlay.render())
+
+      changes = self.overlay.changes()
+      if not changes:
+        return None
+      self.mapSeq += 1
+      return board.diffFrame(self.mapSeq, changes)
+
   def updateGameMap(self):
+    tick = 0
     while True:
       # update game board
-      sender.send_value(config.gameMasterHostName,config.gameMapKey, board.boardToStr(self.board, False))
+      try:
+        frame = self.nextMapFrame(tick)
+        if frame is not None:
+          sender.send_value(self.gameHostName, config.gameMapKey, frame)
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
+      tick += 1
+      time.sleep(0.25)
+
+  def collectViews(self, tick):
+    # Views are only rebuilt after a player moved, and only views that
+    # differ from the last successful send are published. Every
+    # mapKeyframeInterval ticks all views go out again, like the keyframes,
+    # so a client that joined late gets its view without anyone moving
+    with self.overlayLock:
+      if tick % config.mapKeyframeInterval == 0:
+        self.sentViews = {}
+        self.viewsVersion = None
+
+      version = self.overlay.version
+      if version == self.viewsVersion:
+        return []
+
+      batch = []
+      for hostname in self.overlay.players:
+        view = self.overlay.view(hostname, config.viewportRadius)
+        if self.sentViews.get(hostname) != view:
+          batch.append((hostname, view))
+
+    if batch:
+      self.viewsBatchVersion = version
+    else:
+      self.viewsVersion = version
+    return batch
+
+  def viewItems(self, batch):
+    return [ItemValue(host, config.playerViewKey, view) for host, view in batch]
+
+  def acknowledgeViews(self, batch, response, chunkSize):
+    # Views of failed chunks are rebuilt and sent again on the next pass
+    failed = failedChunks(response)
+    for idx, (host, view) in enumerate(batch):
+      if idx // chunkSize + 1 not in failed:
+        self.sentViews[host] = view
+    if not failed:
+      self.viewsVersion = self.viewsBatchVersion
+
+  def publishViews(self, tick):
+    batch = self.collectViews(tick)
+    if batch:
+      self.acknowledgeViews(batch, sender.send(self.viewItems(batch)), sender.chunk_size)
+
+  def updateViews(self):
+    tick = 0
+    while True:
+      try:
+        self.publishViews(tick)
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
+      tick += 1
       time.sleep(0.25)
 
   def main(self):
@@ -109,20 +448,187 @@ class Backend:
     time.sleep(2)
     t2.start()
     time.sleep(1)
-    t3.start()
+    if not config.worldChunked:
+      t3.start()
     t4.start()
     time.sleep(1)
     t5.start()
 
+    if streamViews:
+      threading.Thread(target=self.updateViews).start()
+
+
+# Runs the backend stages as coroutines on one event loop, each stage
+# wakes the next one through an event instead of relying on startup sleeps
+class AsyncBackend(AsyncMixin, Backend):
+  def __init__(self, startingBoard, gameHostName=config.gameMasterHostName, groupids=None, api=None):
+    AsyncMixin.__init__(self)
+    Backend.__init__(self, startingBoard, gameHostName, groupids)
+    self.locationsUpdated = asyncio.Event()
+    # Games run by runGames share one transport, its calls are batched
+    self.api = api
+    self.ownsApi = api is None
+
+  async def __ainit__(self):
+    self.loop = asyncio.get_running_loop()
+    if self.ownsApi:
+      self.api = transport.AsyncZabbixTransport()
+      await self.api.login(token=config.zabbixAdminToken)
+    self.sender = AsyncSender(server=config.zabbixServerIP, port=config.zabbixServerPort)
+
+  def setLocations(self, locations):
+    changed = super().setLocations(locations)
+    if changed:
+      # Connector receiver calls this from its own thread
+      self.loop.call_soon_threadsafe(self.locationsUpdated.set)
+    return changed
+
+  async def fetchPlayerLocations(self):
+    return self.parseLocationItems(await self.api.item.get(**self.locationsQuery()))
+
+  async def fetchLocationRecords(self):
+    items = await self.api.item.get(**self.locationsQuery())
+    changed = self.historyItems(items)
+    history = await self.api.history.get(**self.historyQuery(changed)) if changed else []
+    return self.locationRecords(items, history)
+
+  async def getPlayerLocations(self):
+    # Connector records arrive through the receiver of runGames, polling
+    # only resynchronizes then
+    if config.positionIngestMode == 'connector':
+      minInterval = config.positionPollMax
+      fetch = self.fetchPlayerLocations
+    else:
+      minInterval = config.positionPollMin
+      fetch = self.fetchLocationRecords
+
+    # Poll often while players move, back off while nothing changes
+    interval = minInterval
+    while True:
+      try:
+        if self.setLocations(await fetch()):
+          interval = minInterval
+        else:
+          interval = min(interval * 2, config.positionPollMax)
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
+        interval = config.positionPollMax
+      await asyncio.sleep(interval)
+
+  async def parsePlayerLocations(self):
+    while True:
+      await self.locationsUpdated.wait()
+      self.locationsUpdated.clear()
+      with self.locationsChanged:
+        locations = dict(self.locations)
+
+      try:
+        self.applyLocations(locations)
+        self.resetScores([hostname for hostname in locations if hostname not in self.scores])
+        self.scorePlayers(self.takeSteps())
+        self.announceFinishers()
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
+
+  async def updateScores(self):
+    while True:
+      try:
+        batch = self.collectScores()
+        if batch:
+          response = await self.sender.send(self.scoreItems(batch))
+          self.acknowledgeScores(batch, response, self.sender.chunk_size)
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
+      await asyncio.sleep(0.25)
+
+  async def updateGameMap(self):
+    tick = 0
+    while True:
+      try:
+        frame = self.nextMapFrame(tick)
+        if frame is not None:
+          await self.sender.send_value(self.gameHostName, config.gameMapKey, frame)
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
+      tick += 1
+      await asyncio.sleep(0.25)
+
+  async def updateViews(self):
+    tick = 0
+    while True:
+      try:
+        batch = self.collectViews(tick)
+        if batch:
+          response = await self.sender.send(self.viewItems(batch))
+          self.acknowledgeViews(batch, response, self.sender.chunk_size)
+      except Exception as e:
+        print(f'[ Exception ]: {e}')
+      tick += 1
+      await asyncio.sleep(0.25)
+
+  async def main(self):
+    stages = [
+      self.getPlayerLocations(),
+      self.parsePlayerLocations(),
+      self.updateScores()
+    ]
+    if not config.worldChunked:
+      stages.append(self.updateGameMap())
+    if streamViews:
+      stages.append(self.updateViews())
+
+    try:
+      await asyncio.gather(*stages)
+    finally:
+      if self.ownsApi:
+        await self.api.logout()
+
+
+async def runGames(games):
+  sharedApi = transport.AsyncZabbixTransport()
+  await sharedApi.login(token=config.zabbixAdminToken)
+
+  # Resolve the player groups of all games in one request
+  groupGames = [gameHostName for gameHostName, playerGroup in games.items() if playerGroup is not None]
+  groupResults = await sharedApi.batch([
+    ('hostgroup.get', {'filter': {'name': games[gameHostName]}, 'output': ['groupid']})
+    for gameHostName in groupGames
+  ])
+  groupids = {
+    gameHostName: [group['groupid'] for group in groups]
+    for gameHostName, groups in zip(groupGames, groupResults)
+  }
+
+  backends = []
+  for gameHostName in games:
+    startingBoard = None if config.worldChunked else board.buildTerrain()
+    backends.append(await AsyncBackend(startingBoard, gameHostName, groupids.get(gameHostName), sharedApi))
+
+  if config.positionIngestMode == 'connector':
+    server = HTTPServer((config.webServerIP, config.backendServerPort), PositionRequestHandler)
+    server.backend = PositionRouter([(games[backend.gameHostName], backend) for backend in backends])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  try:
+    await asyncio.gather(*(backend.main() for backend in backends))
+  finally:
+    await sharedApi.logout()
+
 
 if __name__ == "__main__":
   try:
     print('Backend script running')
-    startingBoard = board.build()
-    response = sender.send_value(config.gameMasterHostName, config.gameMapKey, board.boardToStr(startingBoard))
+    if config.backendAsync:
+      asyncio.run(runGames(config.backendGames))
+    elif config.worldChunked:
+      backend = Backend(None)
+      backend.main()
+    else:
+      startingBoard = board.buildTerrain()
+      response = sender.send_value(config.gameMasterHostName, config.gameMapKey, board.keyframe(0, startingBoard))
 
-    backend = Backend(startingBoard)
-    backend.main()
+      backend = Backend(startingBoard)
+      backend.main()
   except Exception as e:
     print(f'[ Exception ]: {e}')
     exit(1)
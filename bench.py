@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+from copy import deepcopy
+import random
+import timeit
+import board
+import config
+
+boardSizes = [40, 200, 1000]
+playerCount = 200
+movesPerTick = 10
+
+
+def timePerCall(func, number):
+  return min(timeit.repeat(func, number=number, repeat=3)) / number * 1000
+
+
+def randomLocations(size):
+  return {f'Player {player}': (random.randrange(size), random.randrange(size)) for player in range(playerCount)}
+
+
+# Old backend tick: deep copy the starting board and write every player into it
+def benchDeepcopyTick(startingBoard, locations, size):
+  startingBoard = board.strToBoard(startingBoard, size)
+
+  def tick():
+    tempBoard = deepcopy(startingBoard)
+    for x, y in locations.values():
+      tempBoard[y][x] = config.symbolPlayer
+  return tick
+
+
+# New backend tick: move the players that changed and render the map string
+def benchOverlayTick(startingBoard, locations, size):
+  overlay = board.BoardOverlay(startingBoard, size)
+  for player, (x, y) in locations.items():
+    overlay.move(player, x, y)
+  players = list(locations)
+
+  def tick():
+    for player in random.sample(players, movesPerTick):
+      overlay.move(player, random.randrange(size), random.randrange(size))
+    overlay.render()
+  return tick
+
+
+def benchParsePlayerLocations():
+  print(f'parsePlayerLocations tick | {playerCount} players, {movesPerTick} moves per tick')
+  print(f'{"size":>6} {"deepcopy ms":>12} {"overlay ms":>12}')
+  for size in boardSizes:
+    startingBoard = board.buildTerrain(size)
+    locations = randomLocations(size)
+    number = max(1, 40000 // (size * size) * 10)
+    deepcopyMs = timePerCall(benchDeepcopyTick(startingBoard, locations, size), max(1, number // 10))
+    overlayMs = timePerCall(benchOverlayTick(startingBoard, locations, size), number)
+    print(f'{size:>6} {deepcopyMs:>12.3f} {overlayMs:>12.3f}')
+  print()
+
+
+# Serialization as it was before the row join rewrite, kept as a baseline
+def legacyBoardToStr(brd, size, fancy=False):
+  retStr = ""
+  for y in range(size):
+    for x in range(size):
+      if fancy:
+        retStr += f'{brd[y][x]} '
+      else:
+        retStr += brd[y][x]
+    if fancy:
+      retStr += '\n'
+  return retStr
+
+
+def legacyStrToBoard(boardStr, size):
+  arrayBuffer = []
+  subArrayBuffer = []
+  counter = 0
+  for current in range(size * size):
+    counter += 1
+    subArrayBuffer.append(boardStr[current])
+    if counter == size:
+      arrayBuffer.append(subArrayBuffer)
+      subArrayBuffer = []
+      counter = 0
+  return arrayBuffer
+
+
+def benchSerialization():
+  print('board serialization')
+  print(f'{"size":>6} {"function":>18} {"legacy ms":>12} {"current ms":>12}')
+  for size in boardSizes:
+    boardStr = board.buildTerrain(size)
+    brd = board.strToBoard(boardStr, size)
+    assert board.boardToStr(brd) == legacyBoardToStr(brd, size)
+    assert board.boardToStr(brd, True) == legacyBoardToStr(brd, size, True)
+    assert board.strToBoard(boardStr, size) == legacyStrToBoard(boardStr, size)
+
+    number = max(1, 40000 // (size * size) * 10)
+    cases = [
+      ('boardToStr', lambda: legacyBoardToStr(brd, size), lambda: board.boardToStr(brd)),
+      ('boardToStr fancy', lambda: legacyBoardToStr(brd, size, True), lambda: board.boardToStr(brd, True)),
+      ('strToBoard', lambda: legacyStrToBoard(boardStr, size), lambda: board.strToBoard(boardStr, size))
+    ]
+    for name, legacy, current in cases:
+      print(f'{size:>6} {name:>18} {timePerCall(legacy, number):>12.3f} {timePerCall(current, number):>12.3f}')
+  print()
+
+
+def benchBuild():
+  print('board generation')
+  print(f'{"size":>6} {"buildTerrain ms":>16} {"build ms":>12}')
+  for size in boardSizes:
+    terrainMs = timePerCall(lambda: board.buildTerrain(size), 3)
+    buildMs = timePerCall(lambda: board.build(size), 3)
+    print(f'{size:>6} {terrainMs:>16.3f} {buildMs:>12.3f}')
+  print()
+
+
+if __name__ == '__main__':
+  benchBuild()
+  benchSerialization()
+  benchParsePlayerLocations()
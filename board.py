@@ -1,10 +1,9 @@
 #!/usr/bin/env python3
 
 import random
-from config import boardSize, wordFull, symbolEmpty, symbolSpawnProbability
+from config import boardSize, wordFull, symbolEmpty, symbolPlayer, symbolSpawnProbability
 
 boardMax = boardSize * boardSize
-walls = []
 
 wordUnique = ''
 for letter in wordFull:
@@ -15,64 +14,273 @@ letterRepeat = 1
 
 # Convert board list to string
 def boardToStr(brd, fancy=False):
-  retStr = ""
-  for y in range(boardSize):
-    for x in range(boardSize):
-      if fancy:
-        retStr += f'{brd[y][x]} '
-      else:
-        retStr += brd[y][x]
-    if fancy:
-      retStr += '\n'
-
-  return retStr
+  if fancy:
+    return ''.join([' '.join(row) + ' \n' for row in brd])
+  return ''.join([''.join(row) for row in brd])
 
 # Convert string to board list
-def strToBoard(boardStr):
-  arrayBuffer = []
+def strToBoard(boardStr, size=boardSize):
+  return [list(boardStr[start:start + size]) for start in range(0, size * size, size)]
 
-  subArrayBuffer = []
-  counter = 0
-  for current in range(boardMax):
-    counter += 1
-    subArrayBuffer.append(boardStr[current])
+# Build the initial board as a list
+def build(size=boardSize, seed=None):
+  return strToBoard(buildTerrain(size, seed), size)
 
-    if counter == boardSize:
-      arrayBuffer.append(subArrayBuffer)
-      subArrayBuffer = []
-      counter = 0
+# Build the initial board as one flat string, one character per cell
+def buildTerrain(size=boardSize, seed=None):
+  rng = random.Random(seed)
+  cells, palette = generateWalls(size, rng)
+  generateLetters(cells, palette, size, rng)
+  return paletteToStr(cells, palette)
 
-  return arrayBuffer
+# Generate walls on the board in one sampling call: every random byte is
+# mapped to a symbol index through a table built from the spawn weights
+def generateWalls(size, rng):
+  palette = list(symbolSpawnProbability)
+  weights = list(symbolSpawnProbability.values())
+  total = sum(weights)
+  if total > 255:
+    return bytearray(rng.choices(range(len(palette)), weights, k=size * size)), palette
 
-# Build the initial board as a list
-def build():
-  generateWallsList()
-  board = []
-  for _ in range(boardSize):
-    yLine = []
-    for _ in range(boardSize):
-      yLine.append(random.choice(walls))
-    board.append(yLine)
-
-  generateLetters(board)
-  return board
-
-# Generate walls on the board
-def generateWallsList():
-  for wallType in symbolSpawnProbability:
-    probability = symbolSpawnProbability[wallType]
-    for _ in range(probability):
-      walls.append(wallType)
-
-# Generate collectable letters on the board
-def generateLetters(board):
+  # Bytes above the last full multiple of total would bias the draw, they
+  # are mapped to 255 and dropped, then the shortfall is drawn again
+  limit = 256 - 256 % total
+  table = bytearray(b'\xff' * 256)
+  value = 0
+  for index, weight in enumerate(weights):
+    for _ in range(weight):
+      for byte in range(value, limit, total):
+        table[byte] = index
+      value += 1
+
+  cells = bytearray()
+  while len(cells) < size * size:
+    missing = size * size - len(cells)
+    cells += rng.randbytes(missing * 256 // limit + 16).translate(table).replace(b'\xff', b'')
+  del cells[size * size:]
+
+  return cells, palette
+
+# Convert symbol indexes to a string, symbols outside latin-1 go
+# through a control character placeholder
+def paletteToStr(cells, palette):
+  table = bytearray(256)
+  replacements = []
+  for index, symbol in enumerate(palette):
+    if ord(symbol) < 256:
+      table[index] = ord(symbol)
+    else:
+      table[index] = index + 1
+      replacements.append((chr(index + 1), symbol))
+
+  boardStr = cells.translate(table).decode('latin-1')
+  for placeholder, symbol in replacements:
+    boardStr = boardStr.replace(placeholder, symbol)
+  return boardStr
+
+# Generate collectable letters on the board by sampling distinct empty
+# cells, empty cells are counted per block and only blocks that receive
+# a letter are scanned
+def generateLetters(cells, palette, size, rng):
+  empty = palette.index(symbolEmpty)
+  letters = []
   for letter in wordUnique:
-    for _ in range(letterRepeat):
-      found = False
-      while not found:
-        x = random.randrange(0, boardSize)
-        y = random.randrange(0, boardSize)
-
-        if board[y][x] == symbolEmpty:
-          board[y][x] = letter
-          found = True
+    palette.append(letter)
+    letters.extend([len(palette) - 1] * letterRepeat)
+
+  blockSize = 4096
+  counts = [cells.count(empty, start, start + blockSize) for start in range(0, size * size, blockSize)]
+  available = sum(counts)
+  if available < len(letters):
+    raise ValueError(f'Board has {available} empty cells, {len(letters)} letters do not fit')
+
+  block = 0
+  seen = 0
+  blockEmpties = None
+  for rank, letter in sorted(zip(rng.sample(range(available), len(letters)), letters)):
+    while seen + counts[block] <= rank:
+      seen += counts[block]
+      block += 1
+      blockEmpties = None
+
+    if blockEmpties is None:
+      start = block * blockSize
+      blockEmpties = [offset for offset in range(start, min(start + blockSize, size * size)) if cells[offset] == empty]
+    cells[blockEmpties[rank - seen]] = letter
+
+
+# Map every letter cell offset to a bitmask of the positions of that letter
+# in the word, so repeated letters are filled in together
+def letterSlots(terrain, word=wordFull):
+  masks = {}
+  for index, letter in enumerate(word):
+    masks[letter] = masks.get(letter, 0) | 1 << index
+
+  slots = {}
+  for letter, mask in masks.items():
+    offset = terrain.find(letter)
+    while offset != -1:
+      slots[offset] = mask
+      offset = terrain.find(letter, offset + 1)
+  return slots
+
+
+# Static terrain kept as one flat string with players tracked separately,
+# so a frame is rendered with a single join instead of copying the board
+class BoardOverlay:
+  def __init__(self, terrain, size=boardSize):
+    self.size = size
+    self.terrain = terrain
+    self.players = {}
+    self.occupied = {}
+    self.dirty = set()
+    self.version = 0
+
+  def move(self, player, x, y):
+    offset = y * self.size + x
+    previous = self.players.get(player)
+    if previous == offset:
+      return False
+
+    if previous is not None:
+      self.vacate(previous)
+    self.players[player] = offset
+    self.occupied[offset] = self.occupied.get(offset, 0) + 1
+    self.markDirty(offset)
+    self.version += 1
+    return True
+
+  def remove(self, player):
+    previous = self.players.pop(player, None)
+    if previous is not None:
+      self.vacate(previous)
+
+  def vacate(self, offset):
+    # Several players can stand on one cell
+    if self.occupied[offset] == 1:
+      del self.occupied[offset]
+      self.markDirty(offset)
+    else:
+      self.occupied[offset] -= 1
+    self.version += 1
+
+  def markDirty(self, offset):
+    self.dirty.add(offset)
+
+  def changes(self):
+    # Cells changed since the last call as (offset, symbol) pairs
+    changed = []
+    for offset in sorted(self.dirty):
+      changed.append((offset, symbolPlayer if offset in self.occupied else self.cell(offset)))
+    self.dirty = set()
+    return changed
+
+  def cell(self, offset):
+    return self.terrain[offset]
+
+  def window(self, x0, y0, width, height):
+    rows = []
+    for y in range(y0, y0 + height):
+      start = y * self.size + x0
+      rows.append(self.terrain[start:start + width])
+    return rows
+
+  def render(self):
+    parts = []
+    start = 0
+    for offset in sorted(self.occupied):
+      parts.append(self.terrain[start:offset])
+      parts.append(symbolPlayer)
+      start = offset + 1
+    parts.append(self.terrain[start:])
+    return ''.join(parts)
+
+  def renderWindow(self, x0, y0, width, height):
+    rows = [list(row) for row in self.window(x0, y0, width, height)]
+
+    # Only cells inside the window are looked up, so one view does not
+    # cost a pass over every player
+    for dy, row in enumerate(rows):
+      start = (y0 + dy) * self.size + x0
+      for dx in range(width):
+        if start + dx in self.occupied:
+          row[dx] = symbolPlayer
+    return ''.join(map(''.join, rows))
+
+  def view(self, player, radius):
+    # Square window around the player, shifted to stay inside the board
+    y, x = divmod(self.players[player], self.size)
+    width = min(2 * radius + 1, self.size)
+    x0 = min(max(x - radius, 0), self.size - width)
+    y0 = min(max(y - radius, 0), self.size - width)
+    return viewFrame(x0, y0, width, self.renderWindow(x0, y0, width, width))
+
+
+# Game map frames: a keyframe carries the full board, a diff frame carries
+# the cells changed since the previous frame as <symbol><offset> pairs and
+# a view frame carries one player's window with its top left corner
+def keyframe(seq, boardStr):
+  return f'K{seq}|{boardStr}'
+
+
+def diffFrame(seq, changes):
+  return f'D{seq}|' + ','.join(f'{symbol}{offset}' for offset, symbol in changes)
+
+
+def viewFrame(x0, y0, width, window):
+  return f'V{x0},{y0},{width}|{window}'
+
+
+# Rebuild the board on the client side from a stream of frames
+class MapDecoder:
+  def __init__(self, size=boardSize):
+    self.size = size
+    self.seq = None
+    self.cells = None
+    self.originX = 0
+    self.originY = 0
+
+  def recenter(self, x, y):
+    # The whole board is kept, only a partial map has to follow the player
+    return False
+
+  def apply(self, frame):
+    header, _, payload = frame.partition('|')
+
+    if header[0] == 'V':
+      # View frames are self-contained, cells outside the window are kept
+      x0, y0, width = map(int, header[1:].split(','))
+      x0 -= self.originX
+      y0 -= self.originY
+      if self.cells is None:
+        self.cells = [symbolEmpty] * (self.size * self.size)
+
+      left = max(x0, 0)
+      right = min(x0 + width, self.size)
+      for row, start in enumerate(range(0, len(payload), width)):
+        y = y0 + row
+        if 0 <= y < self.size and left < right:
+          self.cells[y * self.size + left:y * self.size + right] = payload[start + left - x0:start + right - x0]
+      return True
+
+    seq = int(header[1:])
+    if header[0] == 'K':
+      if len(payload) != self.size * self.size:
+        return False
+      self.cells = list(payload)
+    elif header[0] == 'D':
+      # Diff frames are only valid on top of the previous frame,
+      # after a gap wait for the next keyframe
+      if self.cells is None or seq != self.seq + 1:
+        return False
+      for change in payload.split(','):
+        if change:
+          self.cells[int(change[1:])] = change[0]
+    else:
+      return False
+
+    self.seq = seq
+    return True
+
+  def toStr(self):
+    return ''.join(self.cells)
@@ -8,6 +8,11 @@ zabbixServerPort = 10051
 zabbixAPIPath = f'{zabbixServerIP}/zabbix'
 zabbixAdminToken = ''
 zabbixPlayerToken = ''
+# Zabbix API transport: keep-alive connections per process, request timeout
+# in seconds, and whether concurrent async calls go out as one batch
+apiPoolSize = 4
+apiTimeout = 10
+apiBatch = True
 
 # ==============================
 # Game setup variables
@@ -23,6 +28,15 @@ masterCount = len(masterHost)
 hostgroupPathMaster = 'Workshop/Benelux'
 hostgroupPathPlayer = f'{hostgroupPathMaster}/Player'
 hostgroupPathGame = f'{hostgroupPathMaster}/Game'
+# Independent setup steps run in parallel, at most this many at once
+setupConcurrency = 4
+# New trapper items reject values until the server config cache has them.
+# Setup resends the chunks of starting positions that failed, with a delay
+# doubling from readinessBackoffMin up to readinessBackoffMax seconds, until
+# all are accepted or readinessDeadline seconds have passed
+readinessDeadline = 60
+readinessBackoffMin = 0.2
+readinessBackoffMax = 5
 
 # ==============================
 # Game configuration variables
@@ -30,11 +44,59 @@ hostgroupPathGame = f'{hostgroupPathMaster}/Game'
 webServerIP = '0.0.0.0'
 webServerPort = 8001
 webServerPortMaster = 8002
+# Run the whole client on one asyncio event loop instead of threads
+clientSingleLoop = False
+# Up to this many queued presses of the same key are sent as one move
+inputCoalesceMax = 5
+# The client polls its position and score between playerPollMin and
+# playerPollMax seconds, backing off while nothing changes. It moves its
+# player locally, a server position still different after
+# positionReconcileGrace seconds rolls the player back
+playerPollMin = 0.2
+playerPollMax = 2
+positionReconcileGrace = 2
+# Map frames delivered later than this many seconds are counted as late
+frameLateThreshold = 1
+# Show dropped and late map frames and the average delivery lag below the map
+showFrameStats = True
+
+# Backend position ingestion: 'poll' asks the API with an adaptive interval,
+# 'connector' receives values pushed by a Zabbix connector
+positionIngestMode = 'poll'
+positionPollMin = 0.1
+positionPollMax = 2
+backendHost = '127.0.0.1:8003'
+backendServerPort = 8003
+backendToken = ''
 
 gameMasterHostName = 'Main Game'
 gameMasterHostId = None
 gameMapKey = 'game.map'
 
+# Run the backend on one asyncio event loop instead of threads. Every game
+# host gets its own board, scoped to players of the given host group
+# (None takes all players)
+backendAsync = False
+backendGames = {
+  gameMasterHostName: None
+}
+# Send the full map every N map updates, only changed cells in between
+mapKeyframeInterval = 20
+
+# Publish every player only the map window around their position to a
+# per-player item, their connector then forwards only that item
+mapViewport = False
+viewportRadius = 6
+playerViewKey = 'player.view'
+
+# Tiled world: the map is split into chunkSize x chunkSize chunks generated
+# from worldSeed on demand, players only receive their views
+worldChunked = False
+worldSize = 10000
+chunkSize = 100
+worldSeed = 0
+chunkCacheSize = 1024
+
 playerPositionKey = f'player.position.{zabbixPlayerToken}'
 
 boardSize = 40
@@ -20,3 +20,14 @@ class AsyncMixin:
 
   def __await__(self):
     return self.__initobj().__await__()
+
+
+# Sender splits a batch into chunks of chunk_size, returns the numbers of
+# chunks that had failed values
+def failedChunks(response):
+  failed = set()
+  for chunks in response.details.values():
+    for chunk in chunks:
+      if chunk.failed > 0:
+        failed.add(chunk.chunk)
+  return failed
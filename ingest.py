@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import asyncio
+import threading
+import time
+import json
+import config
+
+
+# Hands map frames from the receiver to the renderer. A keyframe or a view
+# frame replaces everything queued before it, diff frames are queued behind
+# the frame they build on. Frames are ordered by their Zabbix clock and ns,
+# a frame not newer than the newest one seen is a retry or reordered
+# delivery and is dropped. Every accepted frame bumps the version, so the
+# renderer can sleep until there is something new to draw
+class MapMailbox:
+  def __init__(self):
+    self.frames = []
+    self.lock = threading.Lock()
+    self.changed = threading.Condition(self.lock)
+    self.version = 0
+    # Called after a change, lets an event loop wait without a thread
+    self.onChange = None
+    self.newest = (0, 0)
+    self.dropped = 0
+    self.late = 0
+    self.received = 0
+    self.lastLag = 0
+    self.totalLag = 0
+
+  def put(self, records, receivedAt=None):
+    if receivedAt is None:
+      receivedAt = time.time()
+
+    accepted = False
+    with self.lock:
+      for clock, ns, frame in records:
+        if (clock, ns) <= self.newest:
+          self.dropped += 1
+          continue
+        self.newest = (clock, ns)
+
+        # Delivery lag from the moment the value reached Zabbix
+        self.received += 1
+        self.lastLag = receivedAt - clock - ns / 1e9
+        self.totalLag += self.lastLag
+        if self.lastLag > config.frameLateThreshold:
+          self.late += 1
+
+        if frame[:1] in ('K', 'V'):
+          self.frames = [frame]
+        else:
+          self.frames.append(frame)
+        self.version += 1
+        self.changed.notify_all()
+        accepted = True
+
+    if accepted and self.onChange:
+      self.onChange()
+
+  def touch(self):
+    # Wake the renderer without a new frame, e.g. after the player moved
+    with self.lock:
+      self.version += 1
+      self.changed.notify_all()
+
+    if self.onChange:
+      self.onChange()
+
+  def wait(self, version):
+    with self.lock:
+      self.changed.wait_for(lambda: self.version != version)
+      return self.version
+
+  def stats(self):
+    with self.lock:
+      return {
+        'received': self.received,
+        'dropped': self.dropped,
+        'late': self.late,
+        'lastLag': self.lastLag,
+        'averageLag': self.totalLag / self.received if self.received else 0
+      }
+
+  def statusLine(self):
+    stats = self.stats()
+    return f'drop {stats["dropped"]} late {stats["late"]} lag {stats["averageLag"]:.2f}s'
+
+  def take(self):
+    with self.lock:
+      frames = self.frames
+      self.frames = []
+      return frames
+
+
+# Scan the NDJSON body backward and decode only the records from the newest
+# keyframe or view frame on, older records would be replaced anyway.
+# Returns (clock, ns, frame) tuples, oldest first
+def latestFrames(body):
+  records = []
+  end = len(body)
+  while end > 0:
+    start = body.rfind(b'\n', 0, end - 1) + 1
+    line = body[start:end].strip()
+    if line:
+      record = json.loads(line)
+      frame = record['value']
+      records.append((record.get('clock', 0), record.get('ns', 0), frame))
+      if frame[:1] in ('K', 'V'):
+        break
+    end = start
+  records.reverse()
+  return records
+
+
+# Minimal HTTP/1.1 receiver for connector deliveries, connections are kept
+# alive between requests and every body goes straight to the mailbox
+class ZabbixReceiver:
+  def __init__(self, mailbox, token=config.zabbixPlayerToken):
+    self.mailbox = mailbox
+    self.token = token
+    self.server = None
+
+  async def start(self, host=config.webServerIP, port=config.webServerPort):
+    self.server = await asyncio.start_server(self.handle, host, port)
+
+  async def handle(self, reader, writer):
+    try:
+      while True:
+        requestLine = await reader.readline()
+        if not requestLine:
+          break
+
+        headers = {}
+        while True:
+          line = await reader.readline()
+          if line in (b'\r\n', b'\n', b''):
+            break
+          name, _, value = line.decode('latin-1').partition(':')
+          headers[name.strip().lower()] = value.strip()
+
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('authorization') != f'Bearer {self.token}':
+          writer.write(b'HTTP/1.1 401 Unauthorized\r\nContent-Length: 0\r\n\r\n')
+        else:
+          self.mailbox.put(latestFrames(body))
+          writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+        await writer.drain()
+
+        if headers.get('connection', '').lower() == 'close':
+          break
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      writer.close()
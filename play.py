@@ -1,43 +1,24 @@
 #!/usr/bin/env python3
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
 from helpers import AsyncMixin
 
 import board
+import world
+import ingest
+import transport
 import time
 import curses
 import asyncio
 import threading
 import sys
+import os
 import termios
 import tty
-import json
+import signal
 import config
 
 
-zabbixGameMap = None
-mapMaxChars = config.boardSize * config.boardSize
-
-
-class ZabbixRequestHandler(BaseHTTPRequestHandler):
-  def do_POST(self):
-    global zabbixGameMap
-
-    if self.headers.get('Authorization') != f'Bearer {config.zabbixPlayerToken}':
-      self.send_response(401)
-      return
-
-    self.send_response(200)
-    self.end_headers()
-
-    content_len = int(self.headers.get('Content-Length'))
-    post_body = self.rfile.read(content_len)
-    ndjson_content = post_body.decode()
-    zabbixGameMap = json.loads(ndjson_content.splitlines()[-1])['value']
-
-  # Disable log message prints to console
-  def log_message(self, format, *args):
-    return
+worldSize = config.worldSize if config.worldChunked else config.boardSize
 
 
 class Zabbix(AsyncMixin):
@@ -49,71 +30,177 @@ class Zabbix(AsyncMixin):
     self.playerPosition = [0, 0]
     self.counter = 0
     self.gameMap = ''
+    self.mapMailbox = ingest.MapMailbox()
+    if config.worldChunked:
+      self.mapDecoder = world.LocalMap(world.ChunkCache())
+    else:
+      self.mapDecoder = board.MapDecoder()
     self.score = ''
+    self.renderVersion = 0
+    self.rendered = threading.Condition()
+    self.drawnPosition = None
+    # Last position moved to locally that the server has not confirmed yet
+    self.predictedPosition = None
+    self.predictedAt = 0
+    self.onScoreChange = None
+    # Player items polled by pollPlayerState and the clock of their last values
+    self.positionItemId = None
+    self.scoreItemId = None
+    self.itemClocks = {}
+    self.serverPosition = None
 
   async def __ainit__(self):
     # Initialize asynchronous defaults
     # ! IMPLEMENT - asynchronous Zabbix API object
     await self.apiLogin()
     await self.setPlayerHost()
+    await self.setPlayerItems()
     # ! IMPLEMENT - asynchronous Zabbix sender object
 
   # ! IMPLEMENT - API login method
 
   def setMap(self):
-    global zabbixGameMap
+    # Render only when a new frame arrived or the player moved
+    version = 0
     while True:
-      if zabbixGameMap and len(zabbixGameMap) == mapMaxChars:
-        gameMapObj = board.strToBoard(zabbixGameMap)
-        gameMapObj[self.playerPosition[1]][self.playerPosition[0]] = config.symbolCurrentPlayer
-        gameMapObj = board.boardToStr(gameMapObj, True)
-        self.gameMap = gameMapObj.split('\n')
-        time.sleep(0.1)
+      version = self.mapMailbox.wait(version)
+      if self.renderMap():
+        self.publishRender()
+
+  def renderMap(self) -> bool:
+    position = self.playerPosition
+    changed = self.mapDecoder.recenter(position[0], position[1])
+    for frame in self.mapMailbox.take():
+      changed = self.mapDecoder.apply(frame) or changed
+    if not self.mapDecoder.cells or (not changed and position == self.drawnPosition):
+      return False
+
+    gameMapObj = board.strToBoard(self.mapDecoder.toStr(), self.mapDecoder.size)
+    gameMapObj[position[1] - self.mapDecoder.originY][position[0] - self.mapDecoder.originX] = config.symbolCurrentPlayer
+    gameMapObj = board.boardToStr(gameMapObj, True)
+    self.gameMap = gameMapObj.split('\n')
+    self.drawnPosition = position
+    return True
+
+  def publishRender(self):
+    with self.rendered:
+      self.renderVersion += 1
+      self.rendered.notify_all()
+
+  def waitForRender(self, version):
+    with self.rendered:
+      self.rendered.wait_for(lambda: self.renderVersion != version)
+      return self.renderVersion
+
+  def setPlayerPosition(self, position):
+    if position != self.playerPosition:
+      self.playerPosition = position
+      self.mapMailbox.touch()
+
+  def predictPosition(self, position):
+    # The client is authoritative for its own moves, show them right away
+    self.predictedPosition = position
+    self.predictedAt = time.time()
+    self.setPlayerPosition(position)
+
+  def reconcilePosition(self, serverPosition):
+    if serverPosition == self.playerPosition:
+      self.predictedPosition = None
+      return
+
+    # The server may simply not have caught up with the last move yet
+    if self.predictedPosition is not None and time.time() - self.predictedAt < config.positionReconcileGrace:
+      return
+
+    # Mismatch, roll back to the server position
+    self.rollbackPosition(serverPosition)
+
+  def rollbackPosition(self, position):
+    self.predictedPosition = None
+    self.setPlayerPosition(position)
+
+  def setScoreValue(self, score):
+    if score != self.score:
+      self.score = score
+      self.publishRender()
+      if self.onScoreChange:
+        self.onScoreChange()
 
   def getMap(self) -> str:
     return self.gameMap
 
-  # ! IMPLEMENT - request current player position
+  # ! IMPLEMENT - poll player position and score
 
   def getCurrentPosition(self):
     return self.playerPosition
 
+  def getLocalPosition(self):
+    # Position inside the part of the world held by the map decoder
+    return [self.playerPosition[0] - self.mapDecoder.originX, self.playerPosition[1] - self.mapDecoder.originY]
+
   # ! IMPLEMENT - request player host
 
-  # ! IMPLEMENT - request score
+  # ! IMPLEMENT - request player position and score items
 
   def getScore(self):
     return self.score
 
-  async def move(self, direction):
+  async def move(self, direction, steps=1):
     # Get position
     position = self.playerPosition
     x = position[0]
     y = position[1]
 
-    # Set coordinates for next position
+    # Set direction of the move
     if direction == 119:
-      y = position[1] - 1
+      dx, dy = 0, -1
     elif direction == 97:
-      x = position[0] - 1
+      dx, dy = -1, 0
     elif direction == 115:
-      y = position[1] + 1
+      dx, dy = 0, 1
     elif direction == 100:
-      x = position[0] + 1
+      dx, dy = 1, 0
     else:
       return
 
+    # Walk up to steps cells, a coalesced key repeat stops at the first wall.
+    # The backend only scores positions it receives, so it also stops on a
+    # letter to send that cell
+    for _ in range(steps):
+      if not self.canEnter(x + dx, y + dy):
+        break
+      x += dx
+      y += dy
+      cellValue = self.cellAt(x, y)
+      if cellValue is not None and cellValue in config.wordFull:
+        break
+
     # ! IMPLEMENT - async Zabbix sender to send updated position values
-    # Check if new position is not out of map and does not collide with a wall
-    if 0 <= x < config.boardSize and 0 <= y < config.boardSize:
+    if [x, y] != position:
+      self.predictPosition([x, y])
       print(f'Move to direction: {chr(direction).upper()}')
-    #   cellValue = self.gameMap[y][x*2]
-    #   if cellValue not in config.symbolsWalls:
+
+  def cellAt(self, x, y):
+    # Cell of the rendered local map, None outside of it
+    localX = (x - self.mapDecoder.originX) * 2
+    localY = y - self.mapDecoder.originY
+    if not (0 <= localY < len(self.gameMap) and 0 <= localX < len(self.gameMap[localY])):
+      return None
+    return self.gameMap[localY][localX]
+
+  def canEnter(self, x, y):
+    # Check if new position is not out of map and does not collide with a wall
+    if not (0 <= x < worldSize and 0 <= y < worldSize):
+      return False
+    # cellValue = self.gameMap[y - self.mapDecoder.originY][(x - self.mapDecoder.originX) * 2]
+    # return cellValue not in config.symbolsWalls
+    return True
 
 
 class UI:
-  def __init__(self):
+  def __init__(self, mapSize=config.boardSize):
     self.word = ''
+    self.mapSize = mapSize
 
     self.calculateScreen()
 
@@ -122,14 +209,23 @@ class UI:
     # Setup curses windows and a pad
     self.windowBorder = self.stdscr.subwin(13, 24, self.gameRowsMid - 1, self.gameColsMid - 1)
     self.windowScore = self.stdscr.subwin(1, 20, self.gameRowsMid - 2, self.gameColsMid)
-    self.padMap = curses.newpad(config.boardSize + 2, (config.boardSize * 2) + 2)
+    if config.showFrameStats:
+      self.windowStats = self.stdscr.subwin(1, 24, self.gameRowsMid + 12, self.gameColsMid - 1)
+    self.padMap = curses.newpad(self.mapSize + 2, (self.mapSize * 2) + 2)
 
     self.stdscr.clear()
     self.stdscr.refresh()
 
-    self.controlKey = ''
     self.zabbixMap = ''
     self.playerPosition = [0, 0]
+    self.stats = ''
+    self.frameVersion = 0
+    self.frameChanged = threading.Condition()
+
+    # What is on the pad and in the score window right now
+    self.drawnMap = []
+    self.drawnWord = None
+    self.drawnStats = None
 
     self.windowBorder.border(0, 0, 0, 0, 0, 0, 0, 0)
     self.windowBorder.refresh()
@@ -155,43 +251,108 @@ class UI:
     self.windowBorder.erase()
     self.stdscr.clear()
 
-  def refresh1(self):
-    self.windowScore.refresh()
-    self.windowBorder.refresh()
+  def redrawAll(self):
+    # Forget what was drawn so the next frame goes out in full
+    self.stdscr.clear()
+    self.windowBorder.border(0, 0, 0, 0, 0, 0, 0, 0)
+    self.drawnMap = []
+    self.drawnWord = None
+    self.drawnStats = None
+
+  def drawMap(self, gameMap):
+    # Write only the runs of cells that differ from the last drawn frame
+    for line in range(len(gameMap) - 1):
+      row = gameMap[line]
+      drawnRow = self.drawnMap[line] if line < len(self.drawnMap) else ''
+      if row == drawnRow:
+        continue
+
+      start = 0
+      end = len(row)
+      limit = min(len(row), len(drawnRow))
+      while start < limit and row[start] == drawnRow[start]:
+        start += 1
+      if len(row) == len(drawnRow):
+        while end > start and row[end - 1] == drawnRow[end - 1]:
+          end -= 1
+      self.padMap.addstr(1 + line, 1 + start, row[start:end])
+    self.drawnMap = gameMap
+
+  def drawScore(self, word):
+    if word != self.drawnWord:
+      self.windowScore.addstr(0, 0, word)
+      self.windowScore.clrtoeol()
+      self.drawnWord = word
+
+  def drawStats(self, stats):
+    # Last cell of a window can not be written, keep one column free
+    if config.showFrameStats and stats != self.drawnStats:
+      self.windowStats.addstr(0, 0, stats[:23])
+      self.windowStats.clrtoeol()
+      self.drawnStats = stats
 
+  def refresh1(self):
     # Move map accordingly to player position ...
     posY = 0
     posX = 0
     # ... along X axis
-    if self.playerPosition[1] + 6 > config.boardSize:
-      posY = config.boardSize - 10
+    if self.playerPosition[1] + 6 > self.mapSize:
+      posY = self.mapSize - 10
     else:
       posY = self.playerPosition[1] - 4
     # ... along Y axis
-    if self.playerPosition[0] + 6 > config.boardSize:
-      posX = (config.boardSize * 2) - 21
+    if self.playerPosition[0] + 6 > self.mapSize:
+      posX = (self.mapSize * 2) - 21
     else:
       posX = (self.playerPosition[0] * 2) - 9
 
-    self.padMap.refresh(posY, posX, self.gameRowsMid, self.gameColsMid,self.gameRowsMid + 10, self.gameColsMid + 20)
-
-    self.windowScore.addstr(0, 0, self.word)
-    self.stdscr.refresh()
+    # Panning only moves the pad viewport, all windows go out in one update
+    self.stdscr.noutrefresh()
+    self.windowBorder.noutrefresh()
+    self.windowScore.noutrefresh()
+    if config.showFrameStats:
+      self.windowStats.noutrefresh()
+    self.padMap.noutrefresh(posY, posX, self.gameRowsMid, self.gameColsMid,self.gameRowsMid + 10, self.gameColsMid + 20)
+    curses.doupdate()
+
+  def setFrame(self, gameMap, playerPosition, word, stats=''):
+    with self.frameChanged:
+      self.zabbixMap = gameMap
+      self.playerPosition = playerPosition
+      self.word = word
+      self.stats = stats
+      self.frameVersion += 1
+      self.frameChanged.notify_all()
+
+  def checkResize(self) -> bool:
+    # Check if screen size has changed since last update
+    height, width = self.stdscr.getmaxyx()
+    if height != self.height or width != self.width:
+      self.calculateScreen()
+      self.redrawAll()
+      return True
+    return False
+
+  def draw(self):
+    self.drawMap(self.zabbixMap)
+    self.drawScore(self.word)
+    self.drawStats(self.stats)
+    self.refresh1()
 
   def updateScreen(self):
+    drawnVersion = 0
     while True:
-      # Check if screen size has changed since last update
-      height, width = self.stdscr.getmaxyx()
-      if height != self.height or width != self.width:
-        self.calculateScreen()
+      # Sleep until there is a new frame, wake up now and then to catch resizes
+      with self.frameChanged:
+        self.frameChanged.wait_for(lambda: self.frameVersion != drawnVersion, 0.5)
+        version = self.frameVersion
 
-      # Loop through map and add line by line
-      gameMap = self.zabbixMap
-      for line in range(len(gameMap) - 1):
-        self.padMap.addstr(1 + line, 1, gameMap[line])
+      resized = self.checkResize()
+      if version == drawnVersion and not resized:
+        continue
 
-      self.refresh1()
-      time.sleep(0.1)
+      self.draw()
+      drawnVersion = version
 
 
 class Game(AsyncMixin):
@@ -200,17 +361,19 @@ class Game(AsyncMixin):
 
   async def __ainit__(self):
     self.zabbix = await Zabbix()
-    # self.ui = UI()  # <--- uncomment this line
+    self.loop = asyncio.get_running_loop()
+    self.keys = asyncio.Queue()
+    self.pendingKey = None
+    # self.ui = UI(self.zabbix.mapDecoder.size)  # <--- uncomment this line
 
   def updateScreen(self):
     self.ui.updateScreen()
 
   def synchronizeData(self):
+    version = 0
     while True:
-      self.ui.zabbixMap = self.zabbix.getMap()
-      self.ui.playerPosition = self.zabbix.getCurrentPosition()
-      self.ui.word = self.zabbix.getScore()
-      time.sleep(0.1)
+      version = self.zabbix.waitForRender(version)
+      self.ui.setFrame(self.zabbix.getMap(), self.zabbix.getLocalPosition(), self.zabbix.getScore(), self.zabbix.mapMailbox.statusLine())
 
   def getch(self):
     fd = sys.stdin.fileno()
@@ -225,31 +388,88 @@ class Game(AsyncMixin):
   def askInput(self):
     while True:
       i = self.getch()
-      self.ui.controlKey = i
+      self.loop.call_soon_threadsafe(self.keys.put_nowait, i)
+
+  async def nextMove(self):
+    # Take the next key and fold repeats of it already queued into one move
+    if self.pendingKey is not None:
+      key = self.pendingKey
+      self.pendingKey = None
+    else:
+      key = await self.keys.get()
+
+    steps = 1
+    while steps < config.inputCoalesceMax and not self.keys.empty():
+      nextKey = self.keys.get_nowait()
+      if nextKey != key:
+        self.pendingKey = nextKey
+        break
+      steps += 1
+    return key, steps
 
   async def movePlayer(self):
+    # Sends are awaited one by one, keys typed meanwhile wait in the queue
     while True:
-      if self.ui.controlKey != '':
-        await self.zabbix.move(ord(self.ui.controlKey))
-        self.ui.controlKey = ''
-      await asyncio.sleep(0)
+      key, steps = await self.nextMove()
+      await self.zabbix.move(ord(key), steps)
 
   async def movePlayerNoUI(self):
     while True:
       await self.zabbix.move(ord(self.getch()))
       await asyncio.sleep(0.5)
 
-  def startHttpServer(self):
-    with HTTPServer((config.webServerIP, config.webServerPort), ZabbixRequestHandler) as server:
-      server.serve_forever()
+  def readKeys(self):
+    # stdin is readable, queue every key typed since the last call
+    for key in os.read(sys.stdin.fileno(), 64).decode(errors='ignore'):
+      self.keys.put_nowait(key)
+
+  async def render(self):
+    # Parse, overlay and draw only after something changed
+    while True:
+      await self.stateChanged.wait()
+      self.stateChanged.clear()
+      self.zabbix.renderMap()
+      self.ui.zabbixMap = self.zabbix.getMap()
+      self.ui.playerPosition = self.zabbix.getLocalPosition()
+      self.ui.word = self.zabbix.getScore()
+      self.ui.stats = self.zabbix.mapMailbox.statusLine()
+      self.ui.checkResize()
+      self.ui.draw()
+
+  async def runSingleLoop(self):
+    # Input, ingestion, polling and rendering all share this event loop
+    loop = asyncio.get_running_loop()
+    fd = sys.stdin.fileno()
+    orig = termios.tcgetattr(fd)
+
+    self.stateChanged = asyncio.Event()
+    self.zabbix.mapMailbox.onChange = self.stateChanged.set
+    self.zabbix.onScoreChange = self.stateChanged.set
+
+    try:
+      tty.setcbreak(fd)
+      loop.add_reader(fd, self.readKeys)
+      loop.add_signal_handler(signal.SIGWINCH, self.stateChanged.set)
+      await self.startReceiver()
+      await asyncio.gather(self.render(), self.movePlayer(), self.zabbix.pollPlayerState())
+
+    except Exception as e:
+      print(f'[ EXCEPTION ]: {e}')
+      await self.zabbix.api.logout()
+
+    finally:
+      loop.remove_reader(fd)
+      loop.remove_signal_handler(signal.SIGWINCH)
+      termios.tcsetattr(fd, termios.TCSAFLUSH, orig)
+
+  async def startReceiver(self):
+    self.receiver = ingest.ZabbixReceiver(self.zabbix.mapMailbox)
+    await self.receiver.start()
 
   async def run(self):
     try:
       """"""
-      # threadHTTP = threading.Thread(target=self.startHttpServer)
-      # threadHTTP.start()
-
-      # time.sleep(2)
+      # await self.startReceiver()
 
       # threadSetMap = threading.Thread(target=self.zabbix.setMap)
       # threadSetMap.start()
@@ -272,7 +492,10 @@ class Game(AsyncMixin):
 
 async def runGame():
   game = await Game()
-  await game.run()
+  if config.clientSingleLoop:
+    await game.runSingleLoop()
+  else:
+    await game.run()
 
 if __name__ == "__main__":
   try:
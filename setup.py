@@ -1,22 +1,42 @@
 #!/usr/bin/env python3
 
-from zabbix_utils import ZabbixAPI, Sender
+from zabbix_utils import Sender, ItemValue
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import json
 import time
 import random
 import string
 import secrets
+import transport
 import config
 
 
 # ! IMPLEMENT - Create Zabbix API object and authenticate
-api = ZabbixAPI(url=config.zabbixAPIPath, validate_certs=False)
+api = transport.ZabbixTransport(validateCerts=False)
 api.login(token=config.zabbixAdminToken)
 
 
+# =============================================================================
+# Bulk fetch
+# =============================================================================
+def indexBy(objects, field):
+  return {obj[field]: obj for obj in objects}
+
+
+# Runs several get calls in one round-trip, requests maps a result name to
+# (method, params, key field) and every result comes back as a dict by key
+def fetchIndexed(requests):
+  results = api.batch([(method, params) for method, params, field in requests.values()])
+  return {
+    name: indexBy(objects, field)
+    for (name, (method, params, field)), objects in zip(requests.items(), results)
+  }
+
+
 def generateLocations():
-  return [(random.randint(0, config.boardSize - 1), random.randint(0, config.boardSize - 1)) for i in range(config.playerCount)]
+  size = config.worldSize if config.worldChunked else config.boardSize
+  return [(random.randint(0, size - 1), random.randint(0, size - 1)) for i in range(config.playerCount)]
 
 # =============================================================================
 # Users
@@ -51,15 +71,9 @@ def addUsers(roleId):
   print('Adding users')
 
   buffer = {}
-  alphabet = string.ascii_letters + string.digits
-
   users = []
   for player in range(1, config.playerCount + 1):
-    users.append({
-      'username': f'Player {player}',
-      'passwd': ''.join(secrets.choice(alphabet) for i in range(20)),
-      'roleid': int(roleId)
-    })
+    users.append(userObject(player, roleId))
 
   print(f'\tAdding player users')
   createdUsers = api.user.create(users)
@@ -71,6 +85,15 @@ def addUsers(roleId):
   return buffer
 
 
+def userObject(player, roleId):
+  alphabet = string.ascii_letters + string.digits
+  return {
+    'username': f'Player {player}',
+    'passwd': ''.join(secrets.choice(alphabet) for i in range(20)),
+    'roleid': int(roleId)
+  }
+
+
 # =============================================================================
 # User groups
 # =============================================================================
@@ -96,35 +119,35 @@ def removeUserGroups(userGroups):
 
 def addUserGroups(users):
   print('Adding player user groups')
-  hostGroups = getHostGroups(['groupid', 'name'], config.hostgroupPathMaster)
-  gameHostGroupId = None
-  for hostGroup in hostGroups:
-    if hostGroup['name'] == f'{config.hostgroupPathMaster}/Game':
-      gameHostGroupId = hostGroup['groupid']
+  hostGroups = indexBy(getHostGroups(['groupid', 'name'], config.hostgroupPathMaster), 'name')
+  gameHostGroupId = hostGroups.get(f'{config.hostgroupPathMaster}/Game', {}).get('groupid')
 
+  buffer = []
   for player in range(1, config.playerCount + 1):
-    playerHostGroupId = None
-    for hostGroup in hostGroups:
-      if hostGroup['name'] == f'{config.hostgroupPathMaster}/Player/{player}':
-        playerHostGroupId = hostGroup['groupid']
+    playerHostGroupId = hostGroups.get(f'{config.hostgroupPathMaster}/Player/{player}', {}).get('groupid')
+    buffer.append(userGroupObject(player, users[f'Player {player}'], playerHostGroupId, gameHostGroupId))
 
-    api.usergroup.create(
-      name=f'Player {player}',
-      users=[{'userid': users[f'Player {player}']}],
-      hostgroup_rights=[
-        {
-          'id': playerHostGroupId,
-          'permission': 2
-        },
-        {
-          'id': gameHostGroupId,
-          'permission': 2
-        }
-      ]
-    )
+  api.usergroup.create(buffer)
   print('Player user groups added\n')
 
 
+def userGroupObject(player, userId, playerHostGroupId, gameHostGroupId):
+  return {
+    'name': f'Player {player}',
+    'users': [{'userid': userId}],
+    'hostgroup_rights': [
+      {
+        'id': playerHostGroupId,
+        'permission': 2
+      },
+      {
+        'id': gameHostGroupId,
+        'permission': 2
+      }
+    ]
+  }
+
+
 # =============================================================================
 # Roles
 # =============================================================================
@@ -447,14 +470,14 @@ def generateTokens(tokens):
   for token in tokens:
     tokenIds.append(tokens[token])
 
-  generatedTokens = api.token.generate(tokenIds)
+  generatedTokens = indexBy(api.token.generate(tokenIds), 'tokenid')
 
   buffer = {}
   for token in tokens:
-    for genToken in generatedTokens:
-      if genToken['tokenid'] == tokens[token]:
-        buffer[token] = genToken['token']
-        print(f'"{genToken["token"]}",')
+    genToken = generatedTokens.get(tokens[token])
+    if genToken is not None:
+      buffer[token] = genToken['token']
+      print(f'"{genToken["token"]}",')
 
   # write tokens to file
   f = open('playerTokens', 'w')
@@ -498,12 +521,12 @@ def removeHosts(hosts):
 
 def addHostsPlayer():
   print('Adding player hosts')
-  hostGroups = getHostGroups(['groupid', 'name'], config.hostgroupPathPlayer)
+  hostGroups = indexBy(getHostGroups(['groupid', 'name'], config.hostgroupPathPlayer), 'name')
 
   hostsBuffer = []
   for player in range(1, config.playerCount + 1):
-    hostsBuffer.append({'host': f'Player {player}', 'groups': [{'groupid': [
-               hostGroup for hostGroup in hostGroups if hostGroup.get('name') == f'{config.hostgroupPathPlayer}/{player}'][0]['groupid']}]})
+    hostsBuffer.append({'host': f'Player {player}', 'groups': [{
+               'groupid': hostGroups[f'{config.hostgroupPathPlayer}/{player}']['groupid']}]})
 
   addedHosts = api.host.create(hostsBuffer)
 
@@ -559,22 +582,14 @@ def removeHostGroups(hostGroups):
 def addHostGroups():
   print('Adding host groups')
 
-  print('-Adding main host group')
-  api.hostgroup.create(
-    name=f'{config.hostgroupPathMaster}'
-  )
-
-  print('-Adding game host group')
-  api.hostgroup.create(
-    name=f'{config.hostgroupPathGame}'
-  )
-
-  print('-Adding player host groups')
+  buffer = [
+    {'name': f'{config.hostgroupPathMaster}'},
+    {'name': f'{config.hostgroupPathGame}'}
+  ]
   for player in range(1, config.playerCount + 1):
-    api.hostgroup.create(
-      name=f'{config.hostgroupPathPlayer}/{player}'
-    )
+    buffer.append({'name': f'{config.hostgroupPathPlayer}/{player}'})
 
+  api.hostgroup.create(buffer)
   print('Host groups added\n')
 
 # =============================================================================
@@ -582,50 +597,70 @@ def addHostGroups():
 # =============================================================================
 
 
-def getItems(name, params: list):
-  print(f'Getting items | name: {name} | params: {params}')
-  return api.item.get(
-    search={'name': name},
-    output=params
-  )
-
-
 def createItemsPlayer(hosts, tokens):
   print('Creating player items')
   itemsBuffer = []
   for host in hosts:
     print(f'\tfor {host["host"]}')
-    itemkey = f'player.position.{tokens[host["host"]]}'
-    itemObj = {
-      'name': 'Position',
-      'key_': itemkey,
-      'hostid': host['hostid'],
-      'type': 2,
-      'value_type': 1
-    }
-    itemsBuffer.append(itemObj)
-    host['posItemKey'] = itemkey
-
-    itemObj = {
-      'name': 'Score',
-      'key_': 'player.score',
-      'hostid': host['hostid'],
-      'type': 2,
-      'value_type': 1
-    }
-    itemsBuffer.append(itemObj)
+    playerItems = playerItemObjects(host['host'], host['hostid'], tokens[host['host']])
+    itemsBuffer.extend(playerItems)
+    host['posItemKey'] = playerItems[0]['key_']
 
   api.item.create(itemsBuffer)
   print('Done creating player items\n')
   return hosts
 
 
+# Position item first, callers rely on it
+def playerItemObjects(hostName, hostId, token):
+  itemsBuffer = [{
+    'name': 'Position',
+    'key_': f'player.position.{token}',
+    'hostid': hostId,
+    'type': 2,
+    'value_type': 1,
+    'tags': [
+      {
+        'tag': 'game',
+        'value': 'position'
+      }
+    ]
+  }, {
+    'name': 'Score',
+    'key_': 'player.score',
+    'hostid': hostId,
+    'type': 2,
+    'value_type': 1
+  }]
+
+  if config.mapViewport or config.worldChunked:
+    itemsBuffer.append({
+      'name': 'View',
+      'key_': config.playerViewKey,
+      'hostid': hostId,
+      'type': 2,
+      'value_type': 4,
+      'tags': [
+        {
+          'tag': 'view',
+          'value': hostName
+        }
+      ]
+    })
+  return itemsBuffer
+
+
 def createItemsGame(host):
   print('Creating game items')
-  api.item.create({
+  api.item.create(gameItemObjects(host[0]['hostid']))
+  print('Done creating game items\n')
+
+
+def gameItemObjects(hostId):
+  return [{
     'name': 'Map',
     'key_': 'game.map',
-    'hostid': host[0]['hostid'],
+    'hostid': hostId,
     'type': 2,
     'value_type': 4,
     'tags': [
@@ -634,8 +669,39 @@ def createItemsGame(host):
         'value': 'map'
       }
     ]
-  })
-  print('Done creating game items\n')
+  }]
+
+
+# Values of the chunks the server rejected completely, and values of the
+# chunks it accepted only partly. A response does not tell which values of
+# a chunk failed
+def rejectedValues(values, response, chunkSize):
+  chunks = {}
+  for nodeChunks in response.details.values():
+    for chunk in nodeChunks:
+      if chunk.failed > 0:
+        chunks[chunk.chunk] = chunk
+
+  rejected = []
+  partial = []
+  for number, chunk in sorted(chunks.items()):
+    part = values[(number - 1) * chunkSize:number * chunkSize]
+    if chunk.failed == chunk.total:
+      rejected += part
+    else:
+      partial += part
+  return rejected, partial
+
+
+def unheldValues(values):
+  # Values their item does not hold as last value yet
+  items = api.item.get(
+    filter={'host': [value.host for value in values], 'key_': [value.key for value in values]},
+    output=['key_', 'lastvalue'],
+    selectHosts=['host']
+  )
+  held = {(item['hosts'][0]['host'], item['key_'], item['lastvalue']) for item in items}
+  return [value for value in values if (value.host, value.key, value.value) not in held]
 
 
 def populatePlayerHostItems(items):
@@ -643,16 +709,45 @@ def populatePlayerHostItems(items):
   playerCoordinates = generateLocations()
 
   sender = Sender(server=config.zabbixServerIP, port=config.zabbixServerPort)
+  values = []
   for item in items:
     hostNumber = int(item['host'].split(' ')[1]) - 1
     coordinates = f'{playerCoordinates[hostNumber][1]} {playerCoordinates[hostNumber][0]}'
 
     print(
       f'\tsending host: {item["host"]} | item: {item["posItemKey"]} = {coordinates}')
-    resp = sender.send_value(item['host'], item['posItemKey'], coordinates)
-    print(f'\tresponse: {resp}\n')
-
-  print('Done populating player items\n')
+    values.append(ItemValue(item['host'], item['posItemKey'], coordinates))
+
+  # All positions in one trapper request, the sender splits it into chunks.
+  # New items reject values until the server config cache has them, so
+  # rejected values are sent again until every value is accepted. Values of
+  # a partly accepted chunk are read back first, only the ones their item
+  # does not hold are sent again, so accepted values are not duplicated
+  start = time.time()
+  delay = config.readinessBackoffMin
+  unconfirmed = []
+  while True:
+    try:
+      if unconfirmed:
+        values += unheldValues(unconfirmed)
+        unconfirmed = []
+      if values:
+        resp = sender.send(values)
+        print(f'\tresponse: {resp}')
+        values, unconfirmed = rejectedValues(values, resp, sender.chunk_size)
+    except Exception as e:
+      print(f'[ Exception ]: {e}')
+
+    if not values and not unconfirmed:
+      break
+    if time.time() - start + delay > config.readinessDeadline:
+      print(f'{len(values) + len(unconfirmed)} positions not accepted after {config.readinessDeadline}s\n')
+      return False
+    time.sleep(delay)
+    delay = min(delay * 2, config.readinessBackoffMax)
+
+  print(f'Done populating player items after {time.time() - start:.2f}s\n')
+  return True
 
 
 # =============================================================================
@@ -682,7 +777,11 @@ def removeConnectors(connectors):
 
 def addConnectors(tokens):
   print('Adding connectors')
+  api.connector.create(connectorObjects(tokens))
+  print('Done adding connectors\n')
 
+
+def connectorObjects(tokens):
   buffer = []
   for master in range(config.masterCount):
     connectorName = f'Master {master + 1}'
@@ -694,23 +793,29 @@ def addConnectors(tokens):
     connectorName = f'Player {player + 1}'
     connectorUrl = f'http://{config.playerHosts[player]}'
     connectorAuth = tokens[connectorName]
+    if config.mapViewport or config.worldChunked:
+      # Players only get their own view item instead of the whole map
+      buffer.append(generateConnectorItem(
+        connectorName, connectorUrl, connectorAuth, tag='view', tagValue=connectorName))
+    else:
+      buffer.append(generateConnectorItem(
+        connectorName, connectorUrl, connectorAuth))
+  if config.positionIngestMode == 'connector':
     buffer.append(generateConnectorItem(
-      connectorName, connectorUrl, connectorAuth))
-
-  api.connector.create(buffer)
-  print('Done adding connectors\n')
+      'Backend', f'http://{config.backendHost}', config.backendToken, 'position'))
+  return buffer
 
 # returns a list with correct connector properties
 
 
-def generateConnectorItem(name: str, url: str, token: str):
+def generateConnectorItem(name: str, url: str, token: str, tagValue: str = 'map', tag: str = 'game'):
   return {
     'name': name,
     'url': url,
     'tags': [{
-      'tag': 'game',
+      'tag': tag,
       'operator': 0,
-      'value': 'map'
+      'value': tagValue
     }],
     'data_type': 0,
     'max_senders': 1,
@@ -722,78 +827,313 @@ def generateConnectorItem(name: str, url: str, token: str):
 
 
 # =============================================================================
-# Main
+# Reconcile
 # =============================================================================
-def completeReset():
-  # Users
-  oldUsers = getUsers()
-  removeUsers(oldUsers)
-
-  # Roles
-  roles = getRoles()
-  removeRoles(roles)
-  newRoleId = addRole()
-
-  newUsers = addUsers(newRoleId)
-
-  # Hosts
-  hostsPlayer = getHosts('Player', ['hostid', 'name'])
-  removeHosts(hostsPlayer)
-  hostsGame = getHosts('Main Game', ['hostid', 'name'])
-  removeHosts(hostsGame)
+def fetchCurrent():
+  print('Fetching current objects')
+  names = ['roles', 'users', 'hostGroups', 'hosts', 'userGroups', 'tokens', 'connectors']
+  current = dict(zip(names, api.batch([
+    ('role.get', {'filter': {'name': 'Players'}, 'output': ['roleid']}),
+    ('user.get', {'search': {'username': 'Player'}, 'output': ['userid', 'username', 'roleid']}),
+    ('hostgroup.get', {'search': {'name': config.hostgroupPathMaster}, 'output': ['groupid', 'name']}),
+    ('host.get', {'search': {'name': ['Player', 'Main Game']}, 'searchByAny': True,
+                  'output': ['hostid', 'host'], 'selectHostGroups': ['groupid']}),
+    ('usergroup.get', {'search': {'name': 'Player'}, 'output': ['usrgrpid', 'name'],
+                       'selectUsers': ['userid'], 'selectHostGroupRights': ['id', 'permission']}),
+    ('token.get', {'search': {'name': 'Player'}, 'output': ['tokenid', 'name', 'userid']}),
+    ('connector.get', {'output': ['connectorid', 'name', 'url'], 'selectTags': ['tag', 'operator', 'value']})
+  ])))
+
+  hostIds = [host['hostid'] for host in current['hosts']]
+  current['items'] = api.item.get(hostids=hostIds, output=['itemid', 'hostid', 'name', 'key_', 'value_type'], selectTags=['tag', 'value']) if hostIds else []
+  return current
+
+
+# Every reconcile write goes through here, nothing to change means no call
+def applyChange(method, params, writes):
+  if not params:
+    return None
+  print(f'\t{method}: {len(params)}')
+  writes.append(method)
+  return api.call(method, params)
+
+
+def readTokenFile():
+  try:
+    with open('playerTokens') as f:
+      return json.loads(f.read())
+  except (FileNotFoundError, ValueError):
+    return {}
+
+
+def reconcile():
+  start = time.time()
+  writes = []
+  current = fetchCurrent()
+  players = range(1, config.playerCount + 1)
+  playerNames = [f'Player {player}' for player in players]
+
+  # Role
+  print('Reconciling role')
+  if current['roles']:
+    roleId = current['roles'][0]['roleid']
+  else:
+    roleId = addRole()
+    writes.append('role.create')
 
   # Host groups
-  hostGroupMaster = getHostGroups(['groupid'], config.hostgroupPathMaster)
-  removeHostGroups(hostGroupMaster)
+  print('Reconciling host groups')
+  hostGroupNames = [config.hostgroupPathMaster, config.hostgroupPathGame]
+  hostGroupNames += [f'{config.hostgroupPathPlayer}/{player}' for player in players]
+  hostGroups = {hostGroup['name']: hostGroup['groupid'] for hostGroup in current['hostGroups']}
+  missing = [name for name in hostGroupNames if name not in hostGroups]
+  created = applyChange('hostgroup.create', [{'name': name} for name in missing], writes)
+  if created:
+    hostGroups.update(zip(missing, created['groupids']))
 
-  hostGroupPlayers = getHostGroups(['groupid'], config.hostgroupPathPlayer)
-  removeHostGroups(hostGroupPlayers)
+  # Users
+  print('Reconciling users')
+  users = indexBy(current['users'], 'username')
+  missing = [name for name in playerNames if name not in users]
+  created = applyChange('user.create', [userObject(int(name.split(' ')[1]), roleId) for name in missing], writes)
+  userIds = {name: user['userid'] for name, user in users.items() if name in playerNames}
+  if created:
+    userIds.update(zip(missing, created['userids']))
+  applyChange('user.update', [
+    {'userid': user['userid'], 'roleid': roleId}
+    for name, user in users.items() if name in playerNames and user['roleid'] != str(roleId)
+  ], writes)
+  applyChange('user.delete', [user['userid'] for name, user in users.items() if name not in playerNames], writes)
+
+  # Hosts, then the host groups they left
+  print('Reconciling hosts')
+  desiredHosts = {name: hostGroups[f'{config.hostgroupPathPlayer}/{name.split(" ")[1]}'] for name in playerNames}
+  desiredHosts['Main Game'] = hostGroups[config.hostgroupPathGame]
+  hosts = indexBy(current['hosts'], 'host')
+  missing = [name for name in desiredHosts if name not in hosts]
+  created = applyChange('host.create', [{'host': name, 'groups': [{'groupid': desiredHosts[name]}]} for name in missing], writes)
+  hostIds = {name: host['hostid'] for name, host in hosts.items() if name in desiredHosts}
+  if created:
+    hostIds.update(zip(missing, created['hostids']))
+  applyChange('host.update', [
+    {'hostid': host['hostid'], 'groups': [{'groupid': desiredHosts[name]}]}
+    for name, host in hosts.items()
+    if name in desiredHosts and [group['groupid'] for group in host['hostgroups']] != [desiredHosts[name]]
+  ], writes)
+  applyChange('host.delete', [host['hostid'] for name, host in hosts.items() if name not in desiredHosts], writes)
+  applyChange('hostgroup.delete', [groupId for name, groupId in hostGroups.items() if name not in hostGroupNames], writes)
 
-  hostGroupGame = getHostGroups(['groupid'], config.hostgroupPathGame)
-  removeHostGroups(hostGroupGame)
+  # User groups
+  print('Reconciling user groups')
+  gameHostGroupId = hostGroups[config.hostgroupPathGame]
+  desiredUserGroups = {
+    name: userGroupObject(player, userIds[name], hostGroups[f'{config.hostgroupPathPlayer}/{player}'], gameHostGroupId)
+    for player, name in zip(players, playerNames)
+  }
+  userGroups = indexBy(current['userGroups'], 'name')
+  applyChange('usergroup.create', [userGroup for name, userGroup in desiredUserGroups.items() if name not in userGroups], writes)
+  updates = []
+  for name, userGroup in userGroups.items():
+    desired = desiredUserGroups.get(name)
+    if desired is None:
+      continue
+    currentUsers = {user['userid'] for user in userGroup['users']}
+    currentRights = {(right['id'], str(right['permission'])) for right in userGroup['hostgroup_rights']}
+    desiredUsers = {user['userid'] for user in desired['users']}
+    desiredRights = {(right['id'], str(right['permission'])) for right in desired['hostgroup_rights']}
+    if currentUsers != desiredUsers or currentRights != desiredRights:
+      updates.append(dict(desired, usrgrpid=userGroup['usrgrpid']))
+  applyChange('usergroup.update', updates, writes)
+  applyChange('usergroup.delete', [userGroup['usrgrpid'] for name, userGroup in userGroups.items() if name not in desiredUserGroups], writes)
+
+  # Tokens, a token can not be read back so it is only kept while the
+  # playerTokens file still has it
+  print('Reconciling tokens')
+  tokenFile = readTokenFile()
+  liveUserIds = set(userIds.values())
+  tokensByName = {}
+  for token in current['tokens']:
+    if token['userid'] in liveUserIds:
+      tokensByName.setdefault(token['name'], []).append(token)
+
+  tokens = {}
+  renew = []
+  stale = []
+  for name in playerNames:
+    existing = tokensByName.pop(name, [])
+    if name in tokenFile and len(existing) == 1 and existing[0]['userid'] == userIds[name]:
+      tokens[name] = tokenFile[name]
+    else:
+      stale += [token['tokenid'] for token in existing]
+      renew.append(name)
+  stale += [token['tokenid'] for extra in tokensByName.values() for token in extra]
+
+  applyChange('token.delete', stale, writes)
+  created = applyChange('token.create', [{'name': name, 'userid': userIds[name]} for name in renew], writes)
+  if created:
+    generated = applyChange('token.generate', created['tokenids'], writes)
+    generated = {token['tokenid']: token['token'] for token in generated}
+    for name, tokenId in zip(renew, created['tokenids']):
+      tokens[name] = generated[tokenId]
+  if tokens != tokenFile:
+    f = open('playerTokens', 'w')
+    f.write(json.dumps(tokens))
+    f.write(f'\n')
+    f.close()
+
+  # Items, matched by host and name so a new token only changes the key.
+  # Tags route positions and views to the connectors, an item created by
+  # an older setup gets them added here
+  print('Reconciling items')
+  desiredItems = []
+  for name in playerNames:
+    desiredItems += playerItemObjects(name, hostIds[name], tokens[name])
+  desiredItems += gameItemObjects(hostIds['Main Game'])
+  liveHostIds = set(hostIds.values())
+  items = {(item['hostid'], item['name']): item for item in current['items'] if item['hostid'] in liveHostIds}
+  desiredKeys = {(item['hostid'], item['name']) for item in desiredItems}
+
+  hostNames = {hostId: name for name, hostId in hostIds.items()}
+  positions = []
+  creates = []
+  updates = []
+  for item in desiredItems:
+    found = items.get((item['hostid'], item['name']))
+    if found is None:
+      creates.append(item)
+    else:
+      currentTags = {(tag['tag'], tag['value']) for tag in found['tags']}
+      desiredTags = {(tag['tag'], tag['value']) for tag in item.get('tags', [])}
+      if found['key_'] != item['key_'] or str(found['value_type']) != str(item['value_type']) or currentTags != desiredTags:
+        updates.append({'itemid': found['itemid'], 'key_': item['key_'], 'value_type': item['value_type'], 'tags': item.get('tags', [])})
+      if found['key_'] == item['key_']:
+        continue
+    if item['name'] == 'Position':
+      positions.append({'host': hostNames[item['hostid']], 'posItemKey': item['key_']})
+  applyChange('item.create', creates, writes)
+  applyChange('item.update', updates, writes)
+  applyChange('item.delete', [item['itemid'] for key, item in items.items() if key not in desiredKeys], writes)
+
+  # Connectors, their token can not be read back either, renewed tokens
+  # force an update
+  print('Reconciling connectors')
+  desiredConnectors = indexBy(connectorObjects(tokens), 'name')
+  connectors = indexBy(current['connectors'], 'name')
+  applyChange('connector.create', [connector for name, connector in desiredConnectors.items() if name not in connectors], writes)
+  updates = []
+  for name, connector in connectors.items():
+    desired = desiredConnectors.get(name)
+    if desired is None:
+      continue
+    currentTags = {(tag['tag'], str(tag['operator']), tag['value']) for tag in connector['tags']}
+    desiredTags = {(tag['tag'], str(tag['operator']), tag['value']) for tag in desired['tags']}
+    if connector['url'] != desired['url'] or currentTags != desiredTags or name in renew:
+      updates.append(dict(desired, connectorid=connector['connectorid']))
+  applyChange('connector.update', updates, writes)
+  applyChange('connector.delete', [connector['connectorid'] for name, connector in connectors.items() if name not in desiredConnectors], writes)
+
+  # Only new or rekeyed position items need a starting position
+  populated = populatePlayerHostItems(positions) if positions else True
+
+  print(f'Reconcile done: {len(writes)} write calls in {time.time() - start:.2f}s\n')
+  return populated
 
-  addHostGroups()
 
-  playerHosts = addHostsPlayer()
-  gameHost = addHostsGame()
+# =============================================================================
+# Main
+# =============================================================================
+def runPhase(name, steps, timings):
+  # Steps of one phase do not depend on each other and run in parallel
+  start = time.time()
+  index = len(timings)
+  timings.append((name, 0))
+  with ThreadPoolExecutor(max_workers=config.setupConcurrency) as executor:
+    futures = {step: executor.submit(timed, step, func, timings) for step, func in steps.items()}
+    results = {step: future.result() for step, future in futures.items()}
+  timings[index] = (name, time.time() - start)
+  return results
 
-  # User groups
-  userGroups = getUserGroups()
-  removeUserGroups(userGroups)
-  addUserGroups(newUsers)
 
-  # Tokens
-  oldTokens = getTokens()
-  removeTokens(oldTokens)
-  newTokens = addTokens(newUsers)
-  tokens = generateTokens(newTokens)
+def timed(name, func, timings):
+  start = time.time()
+  result = func()
+  timings.append((f'  {name}', time.time() - start))
+  return result
 
-  # Items
-  itemsPlayer = createItemsPlayer(playerHosts, tokens)
-  itemsGame = createItemsGame(gameHost)
 
-  time.sleep(5)
+def printTimings(timings):
+  print('Setup timing')
+  for name, duration in timings:
+    print(f'\t{name:<28} {duration:>8.2f}s')
+  print()
 
-  populatePlayerHostItems(itemsPlayer)
 
-  # Connectors
-  connectors = getConnectors()
-  removeConnectors(connectors)
-  addConnectors(tokens)
+def completeReset():
+  timings = []
+
+  # Removal: hosts go before their host groups, users before their role and
+  # user groups, the tokens of removed users go with them
+  runPhase('Remove', {
+    'users': lambda: removeUsers(getUsers()),
+    'hosts': lambda: removeHosts(getHosts('Player', ['hostid', 'name']) + getHosts('Main Game', ['hostid', 'name'])),
+    'connectors': lambda: removeConnectors(getConnectors())
+  }, timings)
+  runPhase('Remove dependants', {
+    'roles': lambda: removeRoles(getRoles()),
+    'host groups': lambda: removeHostGroups(getHostGroups(['groupid'], config.hostgroupPathMaster)),
+    'user groups': lambda: removeUserGroups(getUserGroups()),
+    'tokens': lambda: removeTokens(getTokens())
+  }, timings)
+
+  # Users and hosts
+  created = runPhase('Add users and hosts', {
+    'users': lambda: addUsers(addRole()),
+    'hosts': lambda: (addHostGroups(), addHostsPlayer(), addHostsGame())
+  }, timings)
+  newUsers = created['users']
+  _, playerHosts, gameHost = created['hosts']
+
+  # User groups, tokens and game items
+  created = runPhase('Add user groups and tokens', {
+    'user groups': lambda: addUserGroups(newUsers),
+    'tokens': lambda: generateTokens(addTokens(newUsers)),
+    'game items': lambda: createItemsGame(gameHost)
+  }, timings)
+  tokens = created['tokens']
+
+  # Player items and connectors
+  created = runPhase('Add items and connectors', {
+    'player items': lambda: createItemsPlayer(playerHosts, tokens),
+    'connectors': lambda: addConnectors(tokens)
+  }, timings)
+  itemsPlayer = created['player items']
+
+  populated = runPhase('Populate', {
+    'positions': lambda: populatePlayerHostItems(itemsPlayer)
+  }, timings)
+
+  printTimings(timings)
+  return populated['positions']
 
 
 def positionReset():
-  hosts = getHosts('Player', ['hostid', 'name'])
-  items = getItems('Position', ['hostid', 'key_'])
+  print('Getting player hosts and position items')
+  current = fetchIndexed({
+    'hosts': ('host.get', {'search': {'name': 'Player'}, 'output': ['hostid', 'name']}, 'hostid'),
+    'items': ('item.get', {'search': {'name': 'Position'}, 'output': ['hostid', 'key_']}, 'hostid')
+  })
+  items = current['items']
   buffer = []
-  for host in hosts:
-    found = next(
-      item for item in items if item['hostid'] == host['hostid'])
+  for hostId, host in current['hosts'].items():
+    found = items.get(hostId)
+    if found is None:
+      print(f'\tno position item on {host["name"]}, skipping')
+      continue
     tmp = {}
     tmp['host'] = host['name']
     tmp['posItemKey'] = found['key_']
     buffer.append(tmp)
-  populatePlayerHostItems(buffer)
+  return populatePlayerHostItems(buffer)
 
 
 def cmd_args_parser():
@@ -804,16 +1144,25 @@ def cmd_args_parser():
              action='store_true', help='Do a full setup.')
   group.add_argument('-p', '--position', dest='actionPartial',
              action='store_true', help='Reset player positions.')
+  group.add_argument('-r', '--reconcile', dest='actionReconcile',
+             action='store_true', help='Apply only the changes between config and Zabbix.')
   args = parser.parse_args()
 
   if args.actionFull is True:
-    completeReset()
+    populated = completeReset()
+  elif args.actionReconcile is True:
+    populated = reconcile()
   elif args.actionPartial is True:
-    positionReset()
+    populated = positionReset()
   else:
     print('Incorrect argument passed.')
     exit(1)
 
+  # Players without a starting position can not play, the setup failed
+  if not populated:
+    print('Setup failed: not every player got a starting position, run with -p to retry')
+    exit(1)
+
 
 if __name__ == '__main__':
   cmd_args_parser()
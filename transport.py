@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+from zabbix_utils.exceptions import APIRequestError
+from urllib.parse import urlsplit
+import http.client
+import asyncio
+import aiohttp
+import itertools
+import queue
+import json
+import ssl
+import config
+
+
+jsonrpcFile = 'api_jsonrpc.php'
+
+
+def apiUrl(url):
+  if not url.endswith(jsonrpcFile):
+    url += jsonrpcFile if url[-1] == '/' else '/' + jsonrpcFile
+  if not url.startswith('http'):
+    url = 'http://' + url
+  return url
+
+
+def checkResponse(response):
+  if 'error' in response:
+    error = response['error']
+    raise APIRequestError(f'{error["message"]} {error.get("data", "")}')
+  return response['result']
+
+
+# api.host.get(...) style access on top of call(), same as zabbix_utils
+class APIObject:
+  def __init__(self, name, transport):
+    self.name = name
+    self.transport = transport
+
+  def __getattr__(self, method):
+    if method.startswith('_'):
+      raise AttributeError(method)
+
+    def request(*args, **kwargs):
+      return self.transport.call(f'{self.name}.{method}', args[0] if args else kwargs)
+    return request
+
+
+class TransportBase:
+  def __init__(self, url, token, validateCerts):
+    self.url = apiUrl(url)
+    self.authToken = token
+    self.ids = itertools.count(1)
+    self.sslContext = None
+    if self.url.startswith('https') and not validateCerts:
+      self.sslContext = ssl.create_default_context()
+      self.sslContext.check_hostname = False
+      self.sslContext.verify_mode = ssl.CERT_NONE
+
+  # Any other attribute is a Zabbix API object, so attributes of the
+  # transport itself must not be named like one (host, token, ...)
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return APIObject(name, self)
+
+  def payload(self, method, params):
+    return {'jsonrpc': '2.0', 'method': method, 'params': {} if params is None else params, 'id': next(self.ids)}
+
+  def headers(self):
+    headers = {'Content-Type': 'application/json-rpc'}
+    if self.authToken:
+      headers['Authorization'] = f'Bearer {self.authToken}'
+    return headers
+
+  def batchResults(self, requests, responses):
+    # Responses of a batch come in any order, match them back by id
+    responses = {response['id']: response for response in responses}
+    return [checkResponse(responses[request['id']]) for request in requests]
+
+
+# Blocking JSON-RPC client for threads. Keeps up to poolSize keep-alive
+# connections open, a thread waits for a free one when all are busy
+class ZabbixTransport(TransportBase):
+  def __init__(self, url=config.zabbixAPIPath, token=None, poolSize=config.apiPoolSize, validateCerts=True):
+    super().__init__(url, token, validateCerts)
+    parts = urlsplit(self.url)
+    self.https = parts.scheme == 'https'
+    self.netloc = parts.netloc
+    self.path = parts.path
+    self.pool = queue.LifoQueue()
+    for _ in range(poolSize):
+      self.pool.put(None)
+
+  def login(self, token):
+    self.authToken = token
+
+  def logout(self):
+    self.close()
+
+  def connect(self):
+    if self.https:
+      return http.client.HTTPSConnection(self.netloc, timeout=config.apiTimeout, context=self.sslContext)
+    return http.client.HTTPConnection(self.netloc, timeout=config.apiTimeout)
+
+  def post(self, body):
+    connection = self.pool.get()
+    try:
+      # A pooled connection may have been closed by the server meanwhile,
+      # retry once on a fresh one
+      for attempt in range(2):
+        if connection is None:
+          connection = self.connect()
+        try:
+          connection.request('POST', self.path, json.dumps(body), self.headers())
+          response = connection.getresponse()
+          data = response.read()
+          if response.status != 200:
+            raise http.client.HTTPException(f'{response.status} {response.reason}')
+          if response.will_close:
+            connection.close()
+            connection = None
+          return json.loads(data)
+        except (http.client.RemoteDisconnected, ConnectionError):
+          connection.close()
+          connection = None
+          if attempt:
+            raise
+        except Exception:
+          connection.close()
+          connection = None
+          raise
+    finally:
+      self.pool.put(connection)
+
+  def call(self, method, params=None):
+    return checkResponse(self.post(self.payload(method, params)))
+
+  def batch(self, calls):
+    # Several (method, params) calls in one HTTP round-trip, results in order
+    requests = [self.payload(method, params) for method, params in calls]
+    if not requests:
+      return []
+    return self.batchResults(requests, self.post(requests))
+
+  def close(self):
+    connections = []
+    while not self.pool.empty():
+      connections.append(self.pool.get())
+    for connection in connections:
+      if connection is not None:
+        connection.close()
+      self.pool.put(None)
+
+
+# Event loop JSON-RPC client on a keep-alive aiohttp session limited to
+# poolSize connections. With batching on, calls made in the same loop
+# iteration are sent together as one batch request
+class AsyncZabbixTransport(TransportBase):
+  def __init__(self, url=config.zabbixAPIPath, token=None, poolSize=config.apiPoolSize, validateCerts=True, batching=config.apiBatch):
+    super().__init__(url, token, validateCerts)
+    self.poolSize = poolSize
+    self.batching = batching
+    self.session = None
+    self.pending = []
+    # The loop only keeps weak references to tasks, hold in-flight sends here
+    self.sending = set()
+
+  async def login(self, token):
+    self.authToken = token
+
+  async def logout(self):
+    await self.close()
+
+  async def post(self, body):
+    if self.session is None:
+      connector = aiohttp.TCPConnector(limit=self.poolSize, ssl=self.sslContext)
+      self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=config.apiTimeout))
+    async with self.session.post(self.url, json=body, headers=self.headers()) as response:
+      response.raise_for_status()
+      return await response.json(content_type=None)
+
+  async def call(self, method, params=None):
+    request = self.payload(method, params)
+    if not self.batching:
+      return checkResponse(await self.post(request))
+
+    future = asyncio.get_running_loop().create_future()
+    if not self.pending:
+      asyncio.get_running_loop().call_soon(self.flush)
+    self.pending.append((request, future))
+    return await future
+
+  def flush(self):
+    pending = self.pending
+    self.pending = []
+    task = asyncio.ensure_future(self.sendPending(pending))
+    self.sending.add(task)
+    task.add_done_callback(self.sending.discard)
+
+  async def sendPending(self, pending):
+    requests = [request for request, future in pending]
+    try:
+      responses = await self.post(requests if len(requests) > 1 else requests[0])
+      if len(requests) == 1:
+        responses = [responses]
+      responses = {response['id']: response for response in responses}
+    except Exception as e:
+      for request, future in pending:
+        if not future.done():
+          future.set_exception(e)
+      return
+
+    for request, future in pending:
+      if future.done():
+        continue
+      try:
+        future.set_result(checkResponse(responses[request['id']]))
+      except Exception as e:
+        future.set_exception(e)
+
+  async def batch(self, calls):
+    requests = [self.payload(method, params) for method, params in calls]
+    if not requests:
+      return []
+    return self.batchResults(requests, await self.post(requests))
+
+  async def close(self):
+    if self.session is not None:
+      await self.session.close()
+      self.session = None
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import threading
+import board
+from config import worldSize, chunkSize, worldSeed, chunkCacheSize
+
+chunksPerSide = worldSize // chunkSize
+
+
+# Chunk IDs number the chunks row by row
+def chunkId(cx, cy):
+  return cy * chunksPerSide + cx
+
+
+def chunkOf(x, y):
+  return x // chunkSize, y // chunkSize
+
+
+# Chunks are generated from the world seed, so the backend and every client
+# build the same terrain without sending it over Zabbix
+def buildChunk(cx, cy):
+  return board.buildTerrain(chunkSize, f'{worldSeed}:{chunkId(cx, cy)}')
+
+
+class ChunkCache:
+  def __init__(self, capacity=chunkCacheSize):
+    self.capacity = capacity
+    self.chunks = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, cx, cy):
+    # Least recently used chunks are evicted and rebuilt on their next use
+    key = chunkId(cx, cy)
+    with self.lock:
+      chunk = self.chunks.get(key)
+      if chunk is None:
+        terrain = buildChunk(cx, cy)
+        chunk = (terrain, board.letterSlots(terrain))
+        self.chunks[key] = chunk
+        if len(self.chunks) > self.capacity:
+          self.chunks.popitem(last=False)
+      else:
+        self.chunks.move_to_end(key)
+      return chunk
+
+  def cell(self, x, y):
+    terrain, _ = self.get(*chunkOf(x, y))
+    return terrain[(y % chunkSize) * chunkSize + x % chunkSize]
+
+  def window(self, x0, y0, width, height):
+    # Rows of the window pieced together from the chunks they cross
+    rows = []
+    for y in range(y0, y0 + height):
+      parts = []
+      x = x0
+      while x < x0 + width:
+        cx, cy = chunkOf(x, y)
+        terrain, _ = self.get(cx, cy)
+        end = min((cx + 1) * chunkSize, x0 + width)
+        start = (y % chunkSize) * chunkSize - cx * chunkSize
+        parts.append(terrain[start + x:start + end])
+        x = end
+      rows.append(''.join(parts))
+    return rows
+
+
+# Letter slots looked up in the chunk of the cell, used like board.letterSlots
+class LetterIndex:
+  def __init__(self, chunks):
+    self.chunks = chunks
+
+  def get(self, offset, default=0):
+    y, x = divmod(offset, worldSize)
+    _, slots = self.chunks.get(*chunkOf(x, y))
+    return slots.get((y % chunkSize) * chunkSize + x % chunkSize, default)
+
+
+# Player overlay on top of the chunked terrain, the world is never rendered
+# as a whole, only windows around players
+class WorldOverlay(board.BoardOverlay):
+  def __init__(self, chunks):
+    super().__init__(None, worldSize)
+    self.chunks = chunks
+
+  def cell(self, offset):
+    y, x = divmod(offset, self.size)
+    return self.chunks.cell(x, y)
+
+  def markDirty(self, offset):
+    # Chunked worlds only stream views, no diff frame ever drains the
+    # changed cells
+    pass
+
+  def window(self, x0, y0, width, height):
+    return self.chunks.window(x0, y0, width, height)
+
+
+# Client map of the 3x3 chunks around the player's chunk, rebuilt from the
+# chunk cache when the player crosses into another chunk
+class LocalMap(board.MapDecoder):
+  def __init__(self, chunks):
+    super().__init__(min(3, chunksPerSide) * chunkSize)
+    self.chunks = chunks
+
+  def recenter(self, x, y):
+    cx, cy = chunkOf(x, y)
+    last = chunksPerSide - self.size // chunkSize
+    originX = min(max(cx - 1, 0), last) * chunkSize
+    originY = min(max(cy - 1, 0), last) * chunkSize
+    if self.cells is not None and originX == self.originX and originY == self.originY:
+      return False
+
+    self.originX = originX
+    self.originY = originY
+    self.cells = list(''.join(self.chunks.window(originX, originY, self.size, self.size)))
+    return True